@@ -1,20 +1,1719 @@
 import asyncio
+import bisect
+import copy
+import functools
+import hashlib
+import heapq
+import json
 import toml
-import tomlkit
 import os
+import random
 import re
-from datetime import datetime
-from typing import Tuple, Optional, Dict, Any, List, Type
+import socket
+import sqlite3
+import time
+from collections import deque
+from datetime import date, datetime, timedelta, time as dt_time
+from types import MappingProxyType
+from typing import Tuple, Optional, Dict, Any, List, Type, Mapping, Iterable, Callable, Awaitable, NamedTuple, Deque
+from zoneinfo import ZoneInfo
 from src.common.logger import get_logger
 from src.plugin_system.base.config_types import ConfigField
 from src.plugin_system.base.base_plugin import BasePlugin
 from src.plugin_system.apis.plugin_register_api import register_plugin
 from src.plugin_system.base.base_command import BaseCommand
+from src.plugin_system.base.base_events_handler import BaseEventHandler
 from src.plugin_system.apis import send_api, chat_api
-from src.plugin_system.base.component_types import ComponentInfo
+from src.plugin_system.base.component_types import ComponentInfo, EventType
 
 logger = get_logger("curfew")
 
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.toml")
+STATE_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "curfew_state.db")
+CLUSTER_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "curfew_cluster.db")
+AUDIT_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "curfew_audit.jsonl")
+CONFIG_STAT_INTERVAL = 1.0  # 两次检查配置文件是否变动之间的最短间隔（秒）
+CONFIG_WRITE_DELAY = 0.5  # 配置修改后等待多久再写盘，这段时间内的修改会合并成一次写入（秒）
+CONFIG_WRITE_RETRY_DELAY = 5  # 写盘失败后多久重试（秒）
+MAX_SCHEDULER_SLEEP = 300  # 定时模式下单次休眠的上限（秒），用来发现系统时钟跳变
+CALENDAR_HORIZON_DAYS = 14  # 宵禁日历每次往后展开多少天
+CALENDAR_MAX_LOOKAHEAD_DAYS = 400  # 找不到下一次切换时最多往后展开多少天
+MAX_EXTEND_MINUTES = 1440  # /curfew tonight extend最多能延长多少分钟
+SCHEDULE_KEYS = ("start_time", "end_time", "timezone", "weekend_start_time", "weekend_end_time")  # 每个群可以单独设置的字段
+
+
+class SystemClock:
+    """插件用到的时钟，离线模拟时可以整体替换成虚拟时钟"""
+
+    @staticmethod
+    def time() -> float:
+        return time.time()
+
+    @staticmethod
+    def monotonic() -> float:
+        return time.monotonic()
+
+
+clock = SystemClock()
+
+
+def _freeze(value: Any) -> Any:
+    """把解析出来的配置递归转换成只读结构"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _build_config(config_data: Dict[str, Any]) -> Dict[str, Any]:
+    """从原始的TOML数据构建配置字典，使用get方法安全访问嵌套值"""
+    return {
+        "curfew": {
+            "start_time": config_data.get("curfew", {}).get("start_time", "23:00"),
+            "end_time": config_data.get("curfew", {}).get("end_time", "06:00"),
+            "check_interval": config_data.get("curfew", {}).get("check_interval", 60),
+            "scheduler_mode": config_data.get("curfew", {}).get("scheduler_mode", "deadline"),
+            "timezone": config_data.get("curfew", {}).get("timezone", ""),
+            "spread_seconds": config_data.get("curfew", {}).get("spread_seconds", 0),
+            "weekend_start_time": config_data.get("curfew", {}).get("weekend_start_time", ""),
+            "weekend_end_time": config_data.get("curfew", {}).get("weekend_end_time", ""),
+            "weekend_days": config_data.get("curfew", {}).get("weekend_days", [4, 5])
+        },
+        "messages": {
+            "mute_message": config_data.get("messages", {}).get("mute_message", "宵禁时间到咯"),
+            "unmute_message": config_data.get("messages", {}).get("unmute_message", "宵禁时间结束咯")
+        },
+        "permissions": {
+            "admin_users": config_data.get("permissions", {}).get("admin_users", []),
+            "groups": config_data.get("permissions", {}).get("groups", []),
+            "denial_reply_cooldown": config_data.get("permissions", {}).get("denial_reply_cooldown", 60)
+        },
+        "retry": {
+            "base_delay": config_data.get("retry", {}).get("base_delay", 5),
+            "max_delay": config_data.get("retry", {}).get("max_delay", 600),
+            "max_attempts": config_data.get("retry", {}).get("max_attempts", 0)
+        },
+        "metrics": {
+            "enabled": config_data.get("metrics", {}).get("enabled", False),
+            "export_path": config_data.get("metrics", {}).get("export_path", ""),
+            "export_interval": config_data.get("metrics", {}).get("export_interval", 60)
+        },
+        "audit": {
+            "enabled": config_data.get("audit", {}).get("enabled", True),
+            "path": config_data.get("audit", {}).get("path", ""),
+            "max_size_mb": config_data.get("audit", {}).get("max_size_mb", 5),
+            "backups": config_data.get("audit", {}).get("backups", 3)
+        },
+        "shutdown": {
+            "drain_timeout": config_data.get("shutdown", {}).get("drain_timeout", 10),
+            "unmute_on_shutdown": config_data.get("shutdown", {}).get("unmute_on_shutdown", False)
+        },
+        "cluster": {
+            "enabled": config_data.get("cluster", {}).get("enabled", False),
+            "db_path": config_data.get("cluster", {}).get("db_path", ""),
+            "instance_id": config_data.get("cluster", {}).get("instance_id", ""),
+            "lease_ttl": config_data.get("cluster", {}).get("lease_ttl", 30),
+            "heartbeat_interval": config_data.get("cluster", {}).get("heartbeat_interval", 10)
+        },
+        "dispatch": {
+            "max_concurrency": config_data.get("dispatch", {}).get("max_concurrency", 8),
+            "rate_per_second": config_data.get("dispatch", {}).get("rate_per_second", 5.0),
+            "burst": config_data.get("dispatch", {}).get("burst", 5),
+            "stream_cache_ttl": config_data.get("dispatch", {}).get("stream_cache_ttl", 604800),
+            "stream_negative_ttl": config_data.get("dispatch", {}).get("stream_negative_ttl", 60)
+        },
+        # 单独设置了宵禁时段的群，没有填写的字段沿用[curfew]里的全局设置
+        "schedules": {
+            _normalize_id(group_id): {
+                key: entry[key] for key in SCHEDULE_KEYS if key in entry
+            }
+            for group_id, entry in config_data.get("schedules", {}).items()
+            if isinstance(entry, dict)
+        },
+        # 节假日、考试周这类单日例外，键是宵禁开始那天的日期（YYYY-MM-DD），对所有群生效
+        "calendar": {
+            str(day): {
+                key: entry[key] for key in ("skip", "start_time", "end_time") if key in entry
+            }
+            for day, entry in config_data.get("calendar", {}).items()
+            if isinstance(entry, dict)
+        }
+    }
+
+
+def _normalize_id(value: Any) -> str:
+    """把QQ号/群号统一规范化为去掉首尾空白的字符串"""
+    if isinstance(value, str):
+        return value.strip()
+    return str(value).strip()
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_clock(value: str) -> dt_time:
+    """解析HH:MM格式的时间，结果会被缓存"""
+    return datetime.strptime(value, "%H:%M").time()
+
+
+def _night_window(day: date, start_time: dt_time, end_time: dt_time) -> Tuple[datetime, datetime]:
+    """某天晚上的宵禁时段对应的墙上时间，结束不晚于开始时视为跨天"""
+    start = datetime.combine(day, start_time)
+    end = datetime.combine(day if start_time < end_time else day + timedelta(days=1), end_time)
+    return start, end
+
+
+@functools.lru_cache(maxsize=64)
+def _load_timezone(name: str) -> Optional[ZoneInfo]:
+    """按名字加载时区，空字符串表示使用系统本地时区"""
+    return ZoneInfo(name) if name else None
+
+
+def group_offset(group_id: str, spread_seconds: int) -> int:
+    """根据群号的哈希给每个群分配一个[0, spread_seconds)内固定的错峰偏移，重启后也不会变"""
+    if not spread_seconds or spread_seconds <= 0:
+        return 0
+    digest = hashlib.sha256(group_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % int(spread_seconds)
+
+
+class GroupSchedule:
+    """一个宵禁日历，规则相同的群会共用同一个对象
+
+    平日/周末时段、[calendar]里的单日例外和/curfew tonight的临时调整会被展开成
+    接下来几天按时间排序的区间端点列表，"现在是否宵禁"和"下一次切换在什么时候"
+    都只需要一次二分查找。时间往后走时只追加新的几天，不会重新展开已有的部分。
+    """
+
+    __slots__ = (
+        "start_text", "end_text", "timezone_name", "start_time", "end_time", "tzinfo",
+        "weekend_start_text", "weekend_end_text", "weekend_days", "weekend_start_time", "weekend_end_time",
+        "exceptions", "overrides", "_exceptions", "_overrides",
+        "_bounds", "_nights", "_night_starts", "_first_day", "_last_day", "_valid_from", "_valid_until",
+    )
+
+    def __init__(
+        self,
+        start_text: str,
+        end_text: str,
+        timezone_name: str = "",
+        weekend_start_text: str = "",
+        weekend_end_text: str = "",
+        weekend_days: Tuple[int, ...] = (),
+        exceptions: Tuple[Tuple[str, bool, str, str], ...] = (),
+        overrides: Tuple[Tuple[str, bool, int], ...] = (),
+    ):
+        self.start_text = start_text
+        self.end_text = end_text
+        self.timezone_name = timezone_name
+        self.start_time = _parse_clock(start_text)
+        self.end_time = _parse_clock(end_text)
+        self.tzinfo = _load_timezone(timezone_name)
+        # 周末时段留空表示和平日一样
+        self.weekend_start_text = weekend_start_text or start_text
+        self.weekend_end_text = weekend_end_text or end_text
+        self.weekend_days = tuple(weekend_days)
+        self.weekend_start_time = _parse_clock(self.weekend_start_text)
+        self.weekend_end_time = _parse_clock(self.weekend_end_text)
+        self.exceptions = tuple(exceptions)
+        self.overrides = tuple(overrides)
+        self._exceptions: Dict[date, Tuple[bool, Optional[dt_time], Optional[dt_time]]] = {
+            date.fromisoformat(day): (skip, _parse_clock(start) if start else None, _parse_clock(end) if end else None)
+            for day, skip, start, end in self.exceptions
+        }
+        self._overrides: Dict[date, Tuple[bool, int]] = {
+            date.fromisoformat(day): (skip, min(max(int(extend), 0), MAX_EXTEND_MINUTES))
+            for day, skip, extend in self.overrides
+        }
+        self._bounds: List[float] = []  # 合并后的区间端点：开始, 结束, 开始, 结束...
+        self._nights: List[Tuple[date, float, float]] = []  # 每晚各自的区间，用来回答"今晚"是哪一晚
+        self._night_starts: List[float] = []
+        self._first_day: Optional[date] = None
+        self._last_day: Optional[date] = None
+        self._valid_from = float("inf")
+        self._valid_until = float("-inf")
+
+    @property
+    def key(self) -> Tuple[Any, ...]:
+        return (
+            self.start_text, self.end_text, self.timezone_name,
+            self.weekend_start_text, self.weekend_end_text, self.weekend_days,
+            self.exceptions, self.overrides,
+        )
+
+    def describe(self, offset: int = 0) -> str:
+        text = self._describe_pair(self.start_time, self.end_time, offset)
+        if self.weekend_days and (self.weekend_start_text, self.weekend_end_text) != (self.start_text, self.end_text):
+            text += "，周末" + self._describe_pair(self.weekend_start_time, self.weekend_end_time, offset)
+        if offset:
+            text += f"（错峰偏移{offset}秒）"
+        return f"{text}（{self.timezone_name}）" if self.timezone_name else text
+
+    @classmethod
+    def _describe_pair(cls, start_time: dt_time, end_time: dt_time, offset: int) -> str:
+        if offset:
+            # 错峰后的实际生效时刻精确到秒
+            return f"{cls._shift(start_time, offset)}~{cls._shift(end_time, offset)}"
+        return f"{start_time.strftime('%H:%M')}~{end_time.strftime('%H:%M')}"
+
+    @staticmethod
+    def _shift(moment: dt_time, offset: int) -> str:
+        return (datetime.combine(datetime.min.date(), moment) + timedelta(seconds=offset)).strftime("%H:%M:%S")
+
+    def is_active(self, now_ts: float, offset: int = 0) -> bool:
+        """给定时间戳是否处于宵禁时段，offset为这个群的错峰偏移"""
+        now_ts -= offset
+        self._ensure(now_ts)
+        return bisect.bisect_right(self._bounds, now_ts) % 2 == 1
+
+    def next_transition(self, now_ts: float, offset: int = 0) -> Optional[float]:
+        """给定时间戳之后最近的一次切换时刻（时间戳），offset为这个群的错峰偏移"""
+        now_ts -= offset
+        self._ensure(now_ts)
+        while True:
+            index = bisect.bisect_right(self._bounds, now_ts)
+            # 最后一个区间的结束时刻可能会和还没展开的下一晚连在一起，只信任展开范围以内的端点
+            if index < len(self._bounds) and self._bounds[index] < self._valid_until:
+                return self._bounds[index] + offset
+            if (self._last_day - self._first_day).days >= CALENDAR_MAX_LOOKAHEAD_DAYS:
+                return None
+            self._compile(self._last_day + timedelta(days=1), self._last_day + timedelta(days=CALENDAR_HORIZON_DAYS))
+
+    def night_at(self, now_ts: float, offset: int = 0) -> Optional[Tuple[date, float, float]]:
+        """正在进行的或者接下来最近的一晚宵禁，返回（宵禁开始那天的日期, 开始时间戳, 结束时间戳）"""
+        now_ts -= offset
+        self._ensure(now_ts)
+        while True:
+            index = bisect.bisect_right(self._night_starts, now_ts) - 1
+            if index >= 0 and self._nights[index][2] > now_ts:
+                day, start, end = self._nights[index]
+                return day, start + offset, end + offset
+            if index + 1 < len(self._nights) and self._nights[index + 1][1] < self._valid_until:
+                day, start, end = self._nights[index + 1]
+                return day, start + offset, end + offset
+            if (self._last_day - self._first_day).days >= CALENDAR_MAX_LOOKAHEAD_DAYS:
+                return None
+            self._compile(self._last_day + timedelta(days=1), self._last_day + timedelta(days=CALENDAR_HORIZON_DAYS))
+
+    def window(self, day: date) -> Optional[Tuple[float, float]]:
+        """某天晚上实际生效的宵禁时段（时间戳），这天晚上不宵禁时返回None"""
+        night = self._night(day)
+        if night is None:
+            return None
+        start, end = _night_window(day, night[0], night[1])
+        return self._stamp(start), self._stamp(end) + night[2]
+
+    def _night(self, day: date) -> Optional[Tuple[dt_time, dt_time, int]]:
+        """按规则算出某天晚上的（开始, 结束, 延长秒数）"""
+        override = self._overrides.get(day)
+        if override is not None and override[0]:
+            return None
+        if day.weekday() in self.weekend_days:
+            start_time, end_time = self.weekend_start_time, self.weekend_end_time
+        else:
+            start_time, end_time = self.start_time, self.end_time
+        exception = self._exceptions.get(day)
+        if exception is not None:
+            if exception[0]:
+                return None
+            start_time = exception[1] or start_time
+            end_time = exception[2] or end_time
+        if start_time == end_time:
+            return None
+        return start_time, end_time, override[1] * 60 if override is not None else 0
+
+    def _stamp(self, moment: datetime) -> float:
+        return moment.replace(tzinfo=self.tzinfo).timestamp()
+
+    def _ensure(self, now_ts: float):
+        """保证索引覆盖给定时刻，只在时间走出已展开的范围时才会重新计算"""
+        if self._valid_from <= now_ts < self._valid_until:
+            return
+        today = datetime.fromtimestamp(now_ts, self.tzinfo).date()
+        horizon = today + timedelta(days=CALENDAR_HORIZON_DAYS)
+        if self._first_day is not None and now_ts >= self._valid_from and today <= self._last_day + timedelta(days=CALENDAR_HORIZON_DAYS):
+            # 时间正常往后走：追加新的几天，丢掉已经用不到的部分
+            self._compile(self._last_day + timedelta(days=1), horizon)
+            self._prune(today - timedelta(days=2))
+        else:
+            # 第一次使用或者系统时间往回跳了，从头展开
+            self._bounds, self._nights, self._night_starts = [], [], []
+            self._first_day = None
+            self._compile(today - timedelta(days=2), horizon)
+
+    def _compile(self, first_day: date, last_day: date):
+        """把[first_day, last_day]这几天的规则展开追加到索引末尾"""
+        if self._first_day is None:
+            self._first_day = first_day
+            # 延长最多一天，再往前一天开始的宵禁不可能影响到first_day两天以后
+            self._valid_from = self._stamp(datetime.combine(first_day + timedelta(days=2), dt_time()))
+        day = first_day
+        while day <= last_day:
+            window = self.window(day)
+            if window is not None and window[1] > window[0]:
+                start, end = window
+                self._nights.append((day, start, end))
+                self._night_starts.append(start)
+                if self._bounds and start <= self._bounds[-1]:
+                    # 和上一晚连在一起（比如被延长了）就合并成一个区间
+                    self._bounds[-1] = max(self._bounds[-1], end)
+                else:
+                    self._bounds.extend((start, end))
+            day += timedelta(days=1)
+        self._last_day = last_day
+        self._valid_until = self._stamp(datetime.combine(last_day + timedelta(days=1), dt_time()))
+
+    def _prune(self, first_day: date):
+        """丢掉first_day之前的几晚"""
+        if first_day <= self._first_day:
+            return
+        self._first_day = first_day
+        self._valid_from = self._stamp(datetime.combine(first_day + timedelta(days=2), dt_time()))
+        keep = bisect.bisect_left(self._night_starts, self._stamp(datetime.combine(first_day, dt_time())))
+        del self._nights[:keep]
+        del self._night_starts[:keep]
+        # 端点成对删除，结束时刻早于新起点的区间都不再需要
+        index = bisect.bisect_left(self._bounds, self._valid_from)
+        del self._bounds[:index - index % 2]
+
+
+_schedule_cache: Dict[Tuple[Any, ...], GroupSchedule] = {}
+
+
+def _calendar_exceptions(calendar: Mapping[str, Mapping[str, Any]]) -> Tuple[Tuple[str, bool, str, str], ...]:
+    """把[calendar]里的单日例外整理成（日期, 是否跳过, 开始, 结束），写错的条目会被跳过"""
+    exceptions = []
+    for day, entry in calendar.items():
+        try:
+            date.fromisoformat(day)
+            start_text = entry.get("start_time", "")
+            end_text = entry.get("end_time", "")
+            for text in (start_text, end_text):
+                if text:
+                    _parse_clock(text)
+        except Exception as e:
+            logger.error(f"[Command:curfew] [calendar]里{day}的配置有误，已跳过: {e}")
+            continue
+        exceptions.append((day, bool(entry.get("skip", False)), start_text, end_text))
+    return tuple(sorted(exceptions))
+
+
+def build_group_schedules(config: Mapping[str, Any], group_ids: Iterable[str], with_overrides: bool = True) -> Dict[str, GroupSchedule]:
+    """为每个群解析出生效的宵禁日历，规则相同的群共用一个GroupSchedule
+
+    已经展开过的日历会被缓存下来，改动某条规则时只有受影响的日历需要重新展开。
+    """
+    curfew_config = config["curfew"]
+    overrides = config["schedules"]
+    weekend_days = tuple(sorted({int(day) % 7 for day in curfew_config["weekend_days"]}))
+    exceptions = _calendar_exceptions(config["calendar"])
+    if len(_schedule_cache) > 1024:
+        _schedule_cache.clear()
+    scoped_overrides = night_overrides.entries if with_overrides else {}
+    missing = object()
+    default: Any = missing  # 没有单独设置、也没有单独调整的群都共用这一个
+    result: Dict[str, GroupSchedule] = {}
+    for group_id in group_ids:
+        entry = overrides.get(group_id)
+        if entry is None and group_id not in scoped_overrides:
+            if default is missing:
+                default = _cached_schedule(group_id, {}, curfew_config, weekend_days, exceptions, night_overrides.for_group(group_id) if with_overrides else ())
+            if default is not None:
+                result[group_id] = default
+            continue
+        schedule = _cached_schedule(group_id, entry or {}, curfew_config, weekend_days, exceptions, night_overrides.for_group(group_id) if with_overrides else ())
+        if schedule is not None:
+            result[group_id] = schedule
+    return result
+
+
+def _cached_schedule(group_id: str, entry: Mapping[str, Any], curfew_config: Mapping[str, Any], weekend_days: Tuple[int, ...], exceptions: Tuple[Any, ...], overrides: Tuple[Any, ...]) -> Optional[GroupSchedule]:
+    """按规则取出缓存的日历，没有就新建一个，规则写错时返回None"""
+    start_text = entry.get("start_time", curfew_config["start_time"])
+    end_text = entry.get("end_time", curfew_config["end_time"])
+    key = (
+        start_text,
+        end_text,
+        entry.get("timezone", curfew_config["timezone"]),
+        # 单独设置了平日时段但没设置周末时段的群，周末也用它自己的平日时段
+        entry.get("weekend_start_time", "" if "start_time" in entry else curfew_config["weekend_start_time"]) or start_text,
+        entry.get("weekend_end_time", "" if "end_time" in entry else curfew_config["weekend_end_time"]) or end_text,
+        weekend_days,
+        exceptions,
+        overrides,
+    )
+    schedule = _schedule_cache.get(key)
+    if schedule is None:
+        try:
+            schedule = GroupSchedule(*key)
+        except Exception as e:
+            logger.error(f"[Command:curfew] 群{group_id}的宵禁时段配置有误，已跳过: {e}")
+            return None
+        _schedule_cache[key] = schedule
+    return schedule
+
+
+class CurfewScheduler:
+    """所有群共用的宵禁调度器
+
+    以（宵禁时段, 错峰偏移）为单位维护一个按下一次切换时间排序的小顶堆，
+    几百个群只要时段和偏移相同就只占一个堆元素，每次只处理到期的那几个。
+    """
+
+    def __init__(self):
+        self.config_version = -1
+        self._slots: Dict[Tuple[Tuple[Any, ...], int], GroupSchedule] = {}
+        self._members: Dict[Tuple[Tuple[Any, ...], int], List[str]] = {}
+        self._heap: List[Tuple[float, Tuple[Tuple[Any, ...], int]]] = []
+
+    def rebuild(self, group_schedules: Dict[str, GroupSchedule], now_ts: float, config_version: Any, spread_seconds: int = 0):
+        """配置或者临时调整变化后重建堆，日历本身由build_group_schedules缓存，这里不会重新展开"""
+        self.config_version = config_version
+        self._slots = {}
+        self._members = {}
+        for group_id, schedule in group_schedules.items():
+            slot = (schedule.key, group_offset(group_id, spread_seconds))
+            self._slots[slot] = schedule
+            self._members.setdefault(slot, []).append(group_id)
+        self._heap = []
+        for slot in self._slots:
+            self._push(slot, now_ts)
+
+    def _push(self, slot: Tuple[Tuple[Any, ...], int], now_ts: float):
+        deadline = self._slots[slot].next_transition(now_ts, slot[1])
+        if deadline is not None:
+            heapq.heappush(self._heap, (deadline, slot))
+
+    def desired_states(self, now_ts: float) -> Dict[str, bool]:
+        """所有群在此刻应处的宵禁状态"""
+        return {
+            group_id: schedule.is_active(now_ts, slot[1])
+            for slot, schedule in self._slots.items()
+            for group_id in self._members[slot]
+        }
+
+    def pop_due(self, now_ts: float) -> Dict[str, bool]:
+        """取出所有已经到期的时段，返回这些时段里的群此刻应处的状态"""
+        due: Dict[str, bool] = {}
+        while self._heap and self._heap[0][0] <= now_ts:
+            _, slot = heapq.heappop(self._heap)
+            state = self._slots[slot].is_active(now_ts, slot[1])
+            for group_id in self._members[slot]:
+                due[group_id] = state
+            self._push(slot, now_ts)
+        return due
+
+    def next_deadline(self) -> Optional[float]:
+        """最近一次切换的时间戳"""
+        return self._heap[0][0] if self._heap else None
+
+
+class TokenBucket:
+    """令牌桶限速器，rate为每秒补充的令牌数，rate<=0表示不限速"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = clock.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int = 1):
+        """取走tokens个令牌，不够时等待补充；要取多个时会连续取完，中间不会被别的调用插队"""
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            for _ in range(tokens):
+                while True:
+                    now = clock.monotonic()
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    # 浮点误差可能让补充后的令牌停在0.999999…，留一点余量避免反复空转
+                    if self._tokens >= 1 - 1e-6:
+                        self._tokens = max(self._tokens - 1, 0.0)
+                        break
+                    await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class UnresolvedGroupError(Exception):
+    """找不到群对应的聊天流（麦麦可能不在这个群里，或者还没收到过这个群的消息）"""
+
+
+class GroupHandedOffError(Exception):
+    """分发过程中这个群已经分给了别的实例，本实例不再操作它"""
+
+
+class StreamResolver:
+    """group_id → stream_id解析结果的缓存
+
+    解析成功的结果缓存ttl秒，解析不到的群缓存negative_ttl秒，避免每次切换都要把所有群重新查一遍。
+    """
+
+    def __init__(self, ttl: float = 604800, negative_ttl: float = 60):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache: Dict[str, Tuple[Optional[str], float]] = {}
+
+    def configure(self, ttl: float, negative_ttl: float):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    def resolve(self, group_id: str) -> str:
+        """返回群对应的stream_id，找不到时抛出UnresolvedGroupError"""
+        now = clock.monotonic()
+        cached = self._cache.get(group_id)
+        if cached is None or cached[1] <= now:
+            cached = self._lookup(group_id, now)
+        if cached[0] is None:
+            raise UnresolvedGroupError(f"找不到群{group_id}对应的聊天流")
+        return cached[0]
+
+    def _lookup(self, group_id: str, now: float) -> Tuple[Optional[str], float]:
+        try:
+            stream = chat_api.get_stream_by_group_id(group_id)
+            stream_id = stream.stream_id if stream is not None else None
+        except Exception as e:
+            logger.warning(f"[Command:curfew] 查询群{group_id}的聊天流失败: {e}")
+            stream_id = None
+        entry = (stream_id, now + (self.ttl if stream_id is not None else self.negative_ttl))
+        self._cache[group_id] = entry
+        return entry
+
+    def warm(self, group_ids: Iterable[str]) -> int:
+        """预先解析一批群，返回解析不到的群数量"""
+        now = clock.monotonic()
+        return sum(1 for group_id in group_ids if self._lookup(group_id, now)[0] is None)
+
+    def invalidate(self, group_id: Optional[str] = None):
+        """清掉某个群（不指定时清掉全部）的缓存"""
+        if group_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(group_id, None)
+
+
+class GroupResult(NamedTuple):
+    """单个群的分发结果，unresolved表示根本没找到群的聊天流，skipped表示插件正在关闭、这个群还没开始就被跳过了，
+    handed_off表示分发途中这个群被分给了别的实例"""
+    group_id: str
+    ok: bool
+    elapsed: float
+    error: Optional[str] = None
+    unresolved: bool = False
+    skipped: bool = False
+    handed_off: bool = False
+
+
+class DispatchReport:
+    """一次分发的汇总，包含每个群的耗时和失败原因"""
+
+    def __init__(self, action: str, results: List[GroupResult], elapsed: float):
+        self.action = action
+        self.results = results
+        self.elapsed = elapsed
+
+    @property
+    def failures(self) -> List[GroupResult]:
+        """发送失败的群（不包括找不到聊天流的、被跳过的和交给别的实例的）"""
+        return [
+            result for result in self.results
+            if not result.ok and not result.unresolved and not result.skipped and not result.handed_off
+        ]
+
+    @property
+    def skipped(self) -> List[GroupResult]:
+        """插件关闭时还没开始、被跳过的群"""
+        return [result for result in self.results if result.skipped]
+
+    @property
+    def handed_off(self) -> List[GroupResult]:
+        """分发途中交给别的实例的群"""
+        return [result for result in self.results if result.handed_off]
+
+    @property
+    def unresolved(self) -> List[GroupResult]:
+        """找不到聊天流的群"""
+        return [result for result in self.results if result.unresolved]
+
+    def summary(self) -> str:
+        slowest = max((result.elapsed for result in self.results), default=0.0)
+        succeeded = sum(1 for result in self.results if result.ok)
+        text = (
+            f"{self.action}：{succeeded}/{len(self.results)}个群成功，"
+            f"总耗时{self.elapsed:.2f}秒，单群最慢{slowest:.2f}秒"
+        )
+        unresolved = len(self.unresolved)
+        if unresolved:
+            text += f"，{unresolved}个群找不到聊天流"
+        handed_off = len(self.handed_off)
+        if handed_off:
+            text += f"，{handed_off}个群已经交给其他实例"
+        skipped = len(self.skipped)
+        return f"{text}，{skipped}个群因为插件关闭没有处理" if skipped else text
+
+
+async def dispatch_to_groups(
+    group_ids: Iterable[str], operation: Callable[[str], Awaitable[Any]], max_concurrency: int,
+    stop: Optional[Callable[[], bool]] = None, on_result: Optional[Callable[[GroupResult], None]] = None,
+) -> List[GroupResult]:
+    """以有限的并发对多个群执行同一个操作，单个群内部的步骤仍然按顺序执行
+
+    stop返回True以后，还没轮到的群直接标记为skipped，已经开始的群会照常做完。
+    on_result会在每个群一有结果时就被调用，整批被取消时已经完成的群也不会丢。
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def attempt(group_id: str) -> GroupResult:
+        if stop is not None and stop():
+            return GroupResult(group_id, False, 0.0, "插件正在关闭", skipped=True)
+        started = clock.monotonic()
+        try:
+            await operation(group_id)
+            return GroupResult(group_id, True, clock.monotonic() - started)
+        except UnresolvedGroupError as e:
+            return GroupResult(group_id, False, clock.monotonic() - started, str(e), unresolved=True)
+        except GroupHandedOffError as e:
+            return GroupResult(group_id, False, clock.monotonic() - started, str(e), handed_off=True)
+        except Exception as e:
+            return GroupResult(group_id, False, clock.monotonic() - started, str(e))
+
+    async def run(group_id: str) -> GroupResult:
+        async with semaphore:
+            result = await attempt(group_id)
+            if on_result is not None:
+                on_result(result)
+            return result
+
+    return list(await asyncio.gather(*(run(group_id) for group_id in group_ids)))
+
+
+class StateStore:
+    """插件运行状态的本地sqlite存储，第一次使用时才会建库"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS retry_queue ("
+                "group_id TEXT PRIMARY KEY, enable INTEGER NOT NULL, attempts INTEGER NOT NULL, "
+                "next_attempt REAL NOT NULL, last_error TEXT)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS group_state ("
+                "group_id TEXT PRIMARY KEY, muted INTEGER NOT NULL, since REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS runtime (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS interrupted ("
+                "group_id TEXT PRIMARY KEY, enable INTEGER NOT NULL, at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS night_override ("
+                "scope TEXT NOT NULL, night TEXT NOT NULL, skip INTEGER NOT NULL, extend INTEGER NOT NULL, "
+                "PRIMARY KEY (scope, night))"
+            )
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def load_retries(self) -> List[Tuple[str, bool, int, float, Optional[str]]]:
+        rows = self.connection().execute(
+            "SELECT group_id, enable, attempts, next_attempt, last_error FROM retry_queue"
+        ).fetchall()
+        return [(group_id, bool(enable), attempts, next_attempt, error) for group_id, enable, attempts, next_attempt, error in rows]
+
+    def save_retry(self, group_id: str, enable: bool, attempts: int, next_attempt: float, last_error: Optional[str]):
+        self.connection().execute(
+            "INSERT OR REPLACE INTO retry_queue VALUES (?, ?, ?, ?, ?)",
+            (group_id, int(enable), attempts, next_attempt, last_error),
+        )
+
+    def delete_retry(self, group_id: str):
+        self.connection().execute("DELETE FROM retry_queue WHERE group_id = ?", (group_id,))
+
+    def load_group_states(self) -> List[Tuple[str, bool, float]]:
+        rows = self.connection().execute("SELECT group_id, muted, since FROM group_state").fetchall()
+        return [(group_id, bool(muted), since) for group_id, muted, since in rows]
+
+    def save_group_state(self, group_id: str, muted: bool, since: float, updated: float):
+        self.connection().execute(
+            "INSERT OR REPLACE INTO group_state VALUES (?, ?, ?, ?)",
+            (group_id, int(muted), since, updated),
+        )
+
+    def delete_group_state(self, group_id: str):
+        self.connection().execute("DELETE FROM group_state WHERE group_id = ?", (group_id,))
+
+    def get_runtime(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        row = self.connection().execute("SELECT value FROM runtime WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_runtime(self, key: str, value: str):
+        self.connection().execute("INSERT OR REPLACE INTO runtime VALUES (?, ?)", (key, value))
+
+    def load_interrupted(self) -> Dict[str, bool]:
+        rows = self.connection().execute("SELECT group_id, enable FROM interrupted").fetchall()
+        return {group_id: bool(enable) for group_id, enable in rows}
+
+    def save_interrupted(self, pending: Mapping[str, bool], now: float):
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM interrupted")
+            conn.executemany(
+                "INSERT INTO interrupted VALUES (?, ?, ?)",
+                [(group_id, int(enable), now) for group_id, enable in pending.items()],
+            )
+
+    def clear_interrupted(self):
+        self.connection().execute("DELETE FROM interrupted")
+
+    def load_night_overrides(self) -> List[Tuple[str, str, bool, int]]:
+        rows = self.connection().execute("SELECT scope, night, skip, extend FROM night_override").fetchall()
+        return [(scope, night, bool(skip), extend) for scope, night, skip, extend in rows]
+
+    def save_night_override(self, scope: str, night: str, skip: bool, extend: int):
+        self.connection().execute(
+            "INSERT OR REPLACE INTO night_override VALUES (?, ?, ?, ?)",
+            (scope, night, int(skip), extend),
+        )
+
+    def delete_night_override(self, scope: str, night: str):
+        self.connection().execute("DELETE FROM night_override WHERE scope = ? AND night = ?", (scope, night))
+
+
+class RetryEntry:
+    """某个群待重试的禁言/解禁操作"""
+
+    __slots__ = ("group_id", "enable", "attempts", "next_attempt", "last_error")
+
+    def __init__(self, group_id: str, enable: bool, attempts: int, next_attempt: float, last_error: Optional[str] = None):
+        self.group_id = group_id
+        self.enable = enable
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+        self.last_error = last_error
+
+
+class RetryQueue:
+    """GROUP_WHOLE_BAN失败后的持久化重试队列
+
+    每个群最多只有一条记录：同一目标状态再次失败会累加次数并指数退避（带随机抖动），
+    目标状态变了就直接用新的记录替换旧的，某个群操作成功后记录会被移除。
+    """
+
+    def __init__(self, store: StateStore):
+        self.store = store
+        self._entries: Optional[Dict[str, RetryEntry]] = None
+        self._changed: Optional[asyncio.Event] = None
+
+    @property
+    def entries(self) -> Dict[str, RetryEntry]:
+        if self._entries is None:
+            self._entries = {}
+            try:
+                for row in self.store.load_retries():
+                    self._entries[row[0]] = RetryEntry(*row)
+            except Exception as e:
+                logger.error(f"[Command:curfew] 读取重试队列失败: {e}")
+        return self._entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def changed_event(self) -> asyncio.Event:
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    def schedule(self, group_id: str, enable: bool, error: Optional[str], retry_config: Mapping[str, Any], now: float) -> Optional[RetryEntry]:
+        """记录一次失败并安排下一次重试，超过最大次数时放弃并返回None"""
+        previous = self.entries.get(group_id)
+        attempts = previous.attempts + 1 if previous is not None and previous.enable == enable else 1
+        max_attempts = retry_config["max_attempts"]
+        if max_attempts and attempts > max_attempts:
+            self.discard(group_id)
+            return None
+        delay = min(retry_config["max_delay"], retry_config["base_delay"] * 2 ** (attempts - 1))
+        delay = random.uniform(delay / 2, delay)
+        entry = RetryEntry(group_id, enable, attempts, now + delay, error)
+        self.entries[group_id] = entry
+        self._persist(entry)
+        self.changed_event().set()
+        return entry
+
+    def discard(self, group_id: str):
+        """移除某个群的重试记录（操作已成功或者不再需要）"""
+        if self.entries.pop(group_id, None) is not None:
+            try:
+                self.store.delete_retry(group_id)
+            except Exception as e:
+                logger.error(f"[Command:curfew] 更新重试队列失败: {e}")
+
+    def is_current(self, entry: RetryEntry) -> bool:
+        """记录在重试期间有没有被更新的目标状态替换掉"""
+        return self.entries.get(entry.group_id) is entry
+
+    def pop_due(self, now: float) -> List[RetryEntry]:
+        return [entry for entry in self.entries.values() if entry.next_attempt <= now]
+
+    def next_due(self) -> Optional[float]:
+        return min((entry.next_attempt for entry in self.entries.values()), default=None)
+
+    def _persist(self, entry: RetryEntry):
+        try:
+            self.store.save_retry(entry.group_id, entry.enable, entry.attempts, entry.next_attempt, entry.last_error)
+        except Exception as e:
+            logger.error(f"[Command:curfew] 写入重试队列失败: {e}")
+
+
+class AppliedStateTable:
+    """每个群最近一次成功下发的禁言状态，用来和目标状态做差异对比
+
+    状态会写进StateStore，重启后可以直接拿来对账，不必给所有群重新发一遍指令。
+    """
+
+    def __init__(self, store: StateStore):
+        self.store = store
+        self._states: Optional[Dict[str, bool]] = None
+        self._since: Dict[str, float] = {}
+        self.pending: Dict[str, bool] = {}  # 已经开始切换、还没有结果的群 → 目标状态
+
+    @property
+    def states(self) -> Dict[str, bool]:
+        if self._states is None:
+            self._states = {}
+            try:
+                for group_id, muted, since in self.store.load_group_states():
+                    self._states[group_id] = muted
+                    self._since[group_id] = since
+            except Exception as e:
+                logger.error(f"[Command:curfew] 读取群状态失败: {e}")
+        return self._states
+
+    def get(self, group_id: str) -> Optional[bool]:
+        return self.states.get(group_id)
+
+    def since(self, group_id: str) -> Optional[float]:
+        return self._since.get(group_id)
+
+    def begin(self, group_ids: Iterable[str], state: bool):
+        """标记这些群开始切换，直到record或settle之前都算没完成"""
+        for group_id in group_ids:
+            self.pending[group_id] = state
+
+    def settle(self, group_id: str):
+        """这个群这次没有切换成功，但已经交给重试队列了"""
+        self.pending.pop(group_id, None)
+
+    def save_interrupted(self, now: float) -> int:
+        """关闭时把还没完成的群记下来，下次启动时优先对账"""
+        try:
+            self.store.save_interrupted(self.pending, now)
+        except Exception as e:
+            logger.error(f"[Command:curfew] 记录未完成的群失败: {e}")
+        return len(self.pending)
+
+    def load_interrupted(self) -> Dict[str, bool]:
+        """上次关闭时没有完成切换的群 → 当时的目标状态"""
+        try:
+            return self.store.load_interrupted()
+        except Exception as e:
+            logger.error(f"[Command:curfew] 读取未完成的群失败: {e}")
+            return {}
+
+    def clear_interrupted(self):
+        try:
+            self.store.clear_interrupted()
+        except Exception as e:
+            logger.error(f"[Command:curfew] 清理未完成的群失败: {e}")
+
+    def record(self, group_id: str, state: bool, now: float):
+        """记录某个群成功切换到的状态"""
+        self.pending.pop(group_id, None)
+        if self.states.get(group_id) != state:
+            self._since[group_id] = now
+        self.states[group_id] = state
+        try:
+            self.store.save_group_state(group_id, state, self._since[group_id], now)
+            self.store.set_runtime("last_transition", str(now))
+        except Exception as e:
+            logger.error(f"[Command:curfew] 写入群状态失败: {e}")
+        # 多实例时同时写进共享库，以后接手这个群的实例可以直接拿来对账
+        cluster.record_state(group_id, state, self._since[group_id], now)
+
+    def adopt(self, group_id: str, state: bool, since: float, now: float):
+        """从其他实例接手某个群时，用共享库里的状态覆盖本地记录"""
+        self.states[group_id] = state
+        self._since[group_id] = since
+        try:
+            self.store.save_group_state(group_id, state, since, now)
+        except Exception as e:
+            logger.error(f"[Command:curfew] 写入群状态失败: {e}")
+
+    def forget(self, group_id: str):
+        self.states.pop(group_id, None)
+        self._since.pop(group_id, None)
+        try:
+            self.store.delete_group_state(group_id)
+        except Exception as e:
+            logger.error(f"[Command:curfew] 写入群状态失败: {e}")
+
+    def muted_groups(self) -> List[str]:
+        return [group_id for group_id, state in self.states.items() if state]
+
+    def diff(self, desired: Mapping[str, bool]) -> Dict[str, bool]:
+        """找出目标状态和已下发状态不一致、并且没有在重试队列里等着的群
+
+        目标状态又变回已下发的状态时，重试队列里要切到另一个状态的旧记录已经过时，顺手丢掉。
+        """
+        changes: Dict[str, bool] = {}
+        for group_id, state in desired.items():
+            pending = retry_queue.entries.get(group_id)
+            if self.states.get(group_id) == state:
+                if pending is not None and pending.enable != state:
+                    retry_queue.discard(group_id)
+                continue
+            if pending is not None and pending.enable == state:
+                continue  # 重试队列会负责把它切换过去
+            changes[group_id] = state
+        return changes
+
+
+class NightOverrideTable:
+    """/curfew tonight设置的临时调整（取消或者延长某一晚），按（群号或"*", 日期）保存在StateStore里
+
+    "*"表示对所有群生效，某个群自己也调整了同一晚时以群自己的为准。
+    每次修改都会让version加一，监控任务据此重新计算受影响的群。
+    """
+
+    GLOBAL = "*"
+
+    def __init__(self, store: StateStore):
+        self.store = store
+        self._entries: Optional[Dict[str, Dict[str, Tuple[bool, int]]]] = None
+        self.version = 0
+
+    @property
+    def entries(self) -> Dict[str, Dict[str, Tuple[bool, int]]]:
+        if self._entries is None:
+            self._entries = {}
+            try:
+                for scope, night, skip, extend in self.store.load_night_overrides():
+                    self._entries.setdefault(scope, {})[night] = (skip, extend)
+            except Exception as e:
+                logger.error(f"[Command:curfew] 读取临时调整失败: {e}")
+        return self._entries
+
+    def for_group(self, group_id: str) -> Tuple[Tuple[str, bool, int], ...]:
+        """某个群生效的临时调整，可以直接作为日历缓存的键"""
+        entries = self.entries
+        if not entries:
+            return ()
+        merged = dict(entries.get(self.GLOBAL, {}))
+        merged.update(entries.get(group_id, {}))
+        return tuple(sorted((night, skip, extend) for night, (skip, extend) in merged.items()))
+
+    def get(self, scope: str, night: str) -> Optional[Tuple[bool, int]]:
+        return self.entries.get(scope, {}).get(night)
+
+    def set(self, scope: str, night: str, skip: bool, extend: int):
+        self.entries.setdefault(scope, {})[night] = (skip, extend)
+        self.version += 1
+        try:
+            self.store.save_night_override(scope, night, skip, extend)
+        except Exception as e:
+            logger.error(f"[Command:curfew] 写入临时调整失败: {e}")
+
+    def clear(self, scope: str, night: str) -> bool:
+        nights = self.entries.get(scope, {})
+        if nights.pop(night, None) is None:
+            return False
+        if not nights:
+            self.entries.pop(scope, None)
+        self.version += 1
+        try:
+            self.store.delete_night_override(scope, night)
+        except Exception as e:
+            logger.error(f"[Command:curfew] 写入临时调整失败: {e}")
+        return True
+
+    def prune(self, before: str):
+        """删掉早于某天的调整，它们已经不会再影响任何一晚"""
+        for scope, nights in list(self.entries.items()):
+            for night in [night for night in nights if night < before]:
+                self.clear(scope, night)
+
+
+def rendezvous_owner(group_id: str, members: Iterable[str]) -> Optional[str]:
+    """rendezvous哈希：群归哈希值最大的那个实例，有实例增减时只有它名下的群会换主人"""
+    best, best_score = None, -1
+    for member in members:
+        score = int.from_bytes(hashlib.sha256(f"{member}|{group_id}".encode("utf-8")).digest()[:8], "big")
+        if score > best_score:
+            best, best_score = member, score
+    return best
+
+
+class ClusterCoordinator:
+    """多个麦麦实例共用同一批群时的分片协调
+
+    每个运行着监控任务的实例会定期在共享的sqlite文件里给自己那一行续租，
+    租约过期的实例视为已经下线。群按rendezvous哈希分给当前存活的实例，
+    某个实例下线后它名下的群会落到剩下的实例上，其余群的归属不变。
+    续租一直失败的实例会在自己的租约到期后停止操作任何群，避免和接手的实例重复操作。
+    没有开启[cluster]时所有群都归本实例。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.path = CLUSTER_DB_PATH
+        self.instance_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_ttl = 30.0
+        self.heartbeat_interval = 10.0
+        self.members: Tuple[str, ...] = ()
+        self.version = 0  # 存活实例或者本实例的租约状态变化时加一
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lease_until = 0.0
+        self._owners: Dict[str, Optional[str]] = {}
+
+    def configure(self, cluster_config: Mapping[str, Any]):
+        enabled = bool(cluster_config["enabled"])
+        path = cluster_config["db_path"] or CLUSTER_DB_PATH
+        instance_id = _normalize_id(cluster_config["instance_id"]) or f"{socket.gethostname()}-{os.getpid()}"
+        if (enabled, path, instance_id) != (self.enabled, self.path, self.instance_id):
+            self.leave()
+            self.close()
+            self.enabled, self.path, self.instance_id = enabled, path, instance_id
+        self.lease_ttl = float(cluster_config["lease_ttl"])
+        self.heartbeat_interval = float(cluster_config["heartbeat_interval"])
+
+    def connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lease ("
+                "instance_id TEXT PRIMARY KEY, expires REAL NOT NULL, heartbeat REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS group_state ("
+                "group_id TEXT PRIMARY KEY, muted INTEGER NOT NULL, since REAL NOT NULL, updated REAL NOT NULL, "
+                "instance_id TEXT NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def heartbeat(self, now: float) -> bool:
+        """续租并刷新存活实例列表，返回存活实例有没有变化"""
+        if not self.enabled:
+            return False
+        try:
+            conn = self.connection()
+            conn.execute("INSERT OR REPLACE INTO lease VALUES (?, ?, ?)", (self.instance_id, now + self.lease_ttl, now))
+            rows = conn.execute("SELECT instance_id FROM lease WHERE expires > ? ORDER BY instance_id", (now,)).fetchall()
+            # 早就下线的实例顺手清理掉
+            conn.execute("DELETE FROM lease WHERE expires < ?", (now - 10 * self.lease_ttl,))
+            self._lease_until = now + self.lease_ttl
+        except Exception as e:
+            logger.error(f"[Command:curfew] 续租失败: {e}")
+            return False
+        members = tuple(row[0] for row in rows)
+        if members == self.members:
+            return False
+        logger.info(f"[Command:curfew] 存活实例变为: {', '.join(members)}")
+        self.members = members
+        self._owners = {}
+        self.version += 1
+        return True
+
+    def leave(self):
+        """主动让出租约，其他实例下一次续租时就会接手本实例的群"""
+        if not self.enabled or not self._lease_until:
+            return
+        self._lease_until = 0.0
+        self.members = ()
+        self._owners = {}
+        self.version += 1
+        try:
+            self.connection().execute("DELETE FROM lease WHERE instance_id = ?", (self.instance_id,))
+        except Exception as e:
+            logger.error(f"[Command:curfew] 释放租约失败: {e}")
+
+    def alive(self) -> bool:
+        """本实例的租约是否还有效（没开启多实例协调时总是有效）"""
+        return not self.enabled or clock.time() < self._lease_until
+
+    def is_last_member(self) -> bool:
+        return not self.enabled or self.members in ((), (self.instance_id,))
+
+    def owns(self, group_id: str) -> bool:
+        if not self.enabled:
+            return True
+        if not self.alive():
+            return False
+        owner = self._owners.get(group_id, self)
+        if owner is self:
+            owner = self._owners[group_id] = rendezvous_owner(group_id, self.members)
+        return owner == self.instance_id
+
+    def shard(self, group_ids: Iterable[str]) -> List[str]:
+        """本实例负责的那部分群"""
+        if not self.enabled:
+            return list(group_ids)
+        return [group_id for group_id in group_ids if self.owns(group_id)]
+
+    def record_state(self, group_id: str, muted: bool, since: float, now: float):
+        if not self.enabled:
+            return
+        try:
+            self.connection().execute(
+                "INSERT OR REPLACE INTO group_state VALUES (?, ?, ?, ?, ?)",
+                (group_id, int(muted), since, now, self.instance_id),
+            )
+        except Exception as e:
+            logger.error(f"[Command:curfew] 写入共享群状态失败: {e}")
+
+    def load_states(self, group_ids: Iterable[str]) -> Dict[str, Tuple[bool, float]]:
+        """共享库里记录的这些群最近一次成功切换到的状态"""
+        group_ids = list(group_ids)
+        if not self.enabled or not group_ids:
+            return {}
+        result: Dict[str, Tuple[bool, float]] = {}
+        try:
+            conn = self.connection()
+            for index in range(0, len(group_ids), 500):
+                chunk = group_ids[index:index + 500]
+                rows = conn.execute(
+                    f"SELECT group_id, muted, since FROM group_state WHERE group_id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                for group_id, muted, since in rows:
+                    result[group_id] = (bool(muted), since)
+        except Exception as e:
+            logger.error(f"[Command:curfew] 读取共享群状态失败: {e}")
+        return result
+
+
+class PermissionIndex:
+    """由配置快照构建的权限索引，所有ID都已规范化，成员检查为O(1)"""
+
+    __slots__ = ("groups", "admin_users", "group_list")
+
+    def __init__(self, groups: Tuple[Any, ...], admin_users: Tuple[Any, ...]):
+        # 保留配置里的顺序并去重，供列表展示和逐群操作使用
+        self.group_list: Tuple[str, ...] = tuple(dict.fromkeys(_normalize_id(g) for g in groups))
+        self.groups: frozenset = frozenset(self.group_list)
+        self.admin_users: frozenset = frozenset(_normalize_id(u) for u in admin_users)
+
+    def has_group(self, group_id: Any) -> bool:
+        return group_id is not None and _normalize_id(group_id) in self.groups
+
+    def is_admin(self, user_id: Any) -> bool:
+        return user_id is not None and _normalize_id(user_id) in self.admin_users
+
+
+class AuditLog:
+    """只追加的操作记录，每行一条JSON，超过大小上限时轮转，最多保留backups个旧文件
+
+    每个群最近的几条记录同时按时间顺序保存在内存里，/curfew status只查内存，
+    不需要翻文件，攒了几个月的历史也一样快。重启后第一次用到时只读当前文件末尾的
+    TAIL_BYTES字节把内存补上，不会扫描整个文件。
+    """
+
+    TAIL_PER_GROUP = 8  # 每个群在内存里保留多少条记录
+    TAIL_BYTES = 64 * 1024  # 启动时从文件末尾读回多少字节的记录
+
+    def __init__(self, path: str):
+        self.enabled = True
+        self.path = path
+        self.max_bytes = 5 * 1024 * 1024
+        self.backups = 3
+        self._recent: Deque[Dict[str, Any]] = deque(maxlen=100)
+        self._groups: Dict[str, Deque[Dict[str, Any]]] = {}
+        self._loaded = False
+        self._file = None
+        self._size = 0
+
+    def configure(self, audit_config: Mapping[str, Any]):
+        path = audit_config["path"] or AUDIT_LOG_PATH
+        if path != self.path:
+            self.close()
+            self.path = path
+        self.enabled = bool(audit_config["enabled"])
+        self.max_bytes = max(int(audit_config["max_size_mb"] * 1024 * 1024), 4096)
+        self.backups = max(int(audit_config["backups"]), 0)
+
+    def record(self, event: str, actor: str, group_id: Optional[str] = None, **fields: Any) -> Dict[str, Any]:
+        """记下一条事件，actor是触发者（用户QQ号、scheduler、retry、shutdown等）"""
+        self._ensure_loaded()
+        entry: Dict[str, Any] = {"ts": round(clock.time(), 3), "event": event, "actor": actor}
+        if group_id is not None:
+            entry["group"] = group_id
+        entry.update(fields)
+        self._remember(entry)
+        if self.enabled:
+            self._write(entry)
+        return entry
+
+    def group_events(self, group_id: str) -> List[Dict[str, Any]]:
+        """某个群在内存里的最近几条记录，按时间先后排列"""
+        self._ensure_loaded()
+        return list(self._groups.get(group_id, ()))
+
+    def last(self, group_id: str, event: str) -> Optional[Dict[str, Any]]:
+        self._ensure_loaded()
+        for entry in reversed(self._groups.get(group_id, ())):
+            if entry["event"] == event:
+                return entry
+        return None
+
+    def latest(self, event: str) -> Optional[Dict[str, Any]]:
+        """内存里最近一条指定类型的记录，不分群"""
+        self._ensure_loaded()
+        for entry in reversed(self._recent):
+            if entry["event"] == event:
+                return entry
+        return None
+
+    def _remember(self, entry: Dict[str, Any]):
+        group_id = entry.get("group")
+        if group_id is not None:
+            tail = self._groups.get(group_id)
+            if tail is None:
+                tail = self._groups[group_id] = deque(maxlen=self.TAIL_PER_GROUP)
+            tail.append(entry)
+        self._recent.append(entry)
+
+    def _ensure_loaded(self):
+        """重启后第一次用到时从文件末尾读回最近的记录，只读TAIL_BYTES字节"""
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.path, "rb") as file:
+                size = file.seek(0, os.SEEK_END)
+                offset = max(size - self.TAIL_BYTES, 0)
+                file.seek(offset)
+                lines = file.read().split(b"\n")
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"[Command:curfew] 读取操作记录失败: {e}")
+            return
+        if offset:
+            lines = lines[1:]  # 第一行多半是从中间截断的
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # 空行，或者上次崩溃时只写了一半的行
+            if isinstance(entry, dict) and "event" in entry:
+                self._remember(entry)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, entry: Dict[str, Any]):
+        line = (json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        try:
+            if self._file is None:
+                self._file = open(self.path, "ab", buffering=0)
+                self._size = self._file.tell()
+            if self._size and self._size + len(line) > self.max_bytes:
+                self._rotate()
+            self._file.write(line)
+            self._size += len(line)
+        except Exception as e:
+            logger.error(f"[Command:curfew] 写入操作记录失败: {e}")
+
+    def _rotate(self):
+        """curfew_audit.jsonl → .1 → .2 …，超出backups的最旧文件会被删掉"""
+        self.close()
+        if self.backups:
+            for index in range(self.backups - 1, 0, -1):
+                older = f"{self.path}.{index}"
+                if os.path.exists(older):
+                    os.replace(older, f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, "ab", buffering=0)
+        self._size = 0
+
+
+class Histogram:
+    """固定分桶的延迟直方图"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """按分桶估算分位数（返回所在桶的上界）"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        running = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            running += count
+            if running >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class CurfewMetrics:
+    """插件内置的计数器和延迟直方图
+
+    没开启时每个记录方法只做一次布尔判断就返回。导出器是接收本对象的可调用对象，
+    可以通过register_exporter挂上自己的实现；配置了export_path时会自动定期写出Prometheus文本格式。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.export_path = ""
+        self.export_interval = 60.0
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+        self._exporters: List[Callable[["CurfewMetrics"], None]] = []
+        self._next_export = 0.0
+
+    def configure(self, metrics_config: Mapping[str, Any]):
+        self.enabled = bool(metrics_config["enabled"])
+        self.export_path = metrics_config["export_path"]
+        self.export_interval = metrics_config["export_interval"]
+
+    def inc(self, name: str, amount: float = 1, **labels: str):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels: str):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def register_exporter(self, exporter: Callable[["CurfewMetrics"], None]):
+        """挂上一个自定义导出器，每次导出时都会被调用"""
+        self._exporters.append(exporter)
+
+    def maybe_export(self):
+        """距离上次导出超过export_interval时执行一次导出"""
+        if not self.enabled or (not self.export_path and not self._exporters):
+            return
+        now = clock.monotonic()
+        if now < self._next_export:
+            return
+        self._next_export = now + self.export_interval
+        self.export()
+
+    def export(self):
+        """立即执行所有导出器"""
+        exporters = list(self._exporters)
+        if self.export_path:
+            exporters.append(write_prometheus_file)
+        for exporter in exporters:
+            try:
+                exporter(self)
+            except Exception as e:
+                logger.error(f"[Command:curfew] 导出统计数据失败: {e}")
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+    def render_prometheus(self) -> str:
+        """生成Prometheus文本格式"""
+        def fmt_labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+            parts = [f'{key}="{value}"' for key, value in labels]
+            if extra:
+                parts.append(extra)
+            return "{" + ",".join(parts) + "}" if parts else ""
+
+        lines: List[str] = []
+        family = None
+        # 同名的序列排序后是挨着的，每个指标只在第一次出现时写一行# TYPE
+        for (name, labels), value in sorted(self.counters.items()):
+            if name != family:
+                family = name
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{fmt_labels(labels)} {value:g}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name != family:
+                family = name
+                lines.append(f"# TYPE {name} histogram")
+            running = 0
+            for bound, count in zip(Histogram.BUCKETS, histogram.counts):
+                running += count
+                bucket_labels = fmt_labels(labels, 'le="%g"' % bound)
+                lines.append(f"{name}_bucket{bucket_labels} {running}")
+            bucket_labels = fmt_labels(labels, 'le="+Inf"')
+            lines.append(f"{name}_bucket{bucket_labels} {histogram.count}")
+            lines.append(f"{name}_sum{fmt_labels(labels)} {histogram.total:.6f}")
+            lines.append(f"{name}_count{fmt_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary_lines(self) -> List[str]:
+        """给/curfew stats用的可读摘要"""
+        def fmt_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+            return "[" + ",".join(value for _, value in labels) + "]" if labels else ""
+
+        lines: List[str] = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{fmt_labels(labels)}: {value:g}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            average = histogram.total / histogram.count if histogram.count else 0.0
+            lines.append(
+                f"{name}{fmt_labels(labels)}: {histogram.count}次，平均{average * 1000:.1f}ms，"
+                f"p95≈{histogram.quantile(0.95) * 1000:.1f}ms，最大{histogram.max * 1000:.1f}ms"
+            )
+        return lines
+
+
+def write_prometheus_file(metrics: CurfewMetrics):
+    """内置导出器：把统计数据以Prometheus文本格式原子地写到export_path"""
+    temp_path = f"{metrics.export_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(metrics.render_prometheus())
+    os.replace(temp_path, metrics.export_path)
+
+
+metrics = CurfewMetrics()
+
+
+class ConfigStore:
+    """config.toml的共享只读快照
+
+    只有当文件的mtime/大小/inode发生变化，或者set_config写入后主动失效时才会重新解析，
+    两次检查文件状态之间至少间隔CONFIG_STAT_INTERVAL秒，因此热重载依然有效，
+    但每条消息都不再需要读文件和解析TOML。
+    """
+
+    def __init__(self, path: str, stat_interval: float = CONFIG_STAT_INTERVAL):
+        self.path = path
+        self.stat_interval = stat_interval
+        self.version = 0  # 每次快照被替换时递增，方便其他缓存判断是否需要重建
+        self._snapshot: Optional[Mapping[str, Any]] = None
+        self._raw: Dict[str, Any] = {}
+        self._signature: Optional[Tuple[int, int, int]] = None
+        self._next_stat = 0.0
+        self._permission_index: Optional[PermissionIndex] = None
+        self._permission_key: Optional[Tuple[Any, Any]] = None
+        self._permission_version = -1
+
+    def get(self) -> Mapping[str, Any]:
+        """返回当前配置快照，必要时重新加载"""
+        now = clock.monotonic()
+        if self._snapshot is not None and config_writer.dirty:
+            # 还有没写盘的修改时以内存为准，写完之后再检查文件
+            return self._snapshot
+        if self._snapshot is None or now >= self._next_stat:
+            self._next_stat = now + self.stat_interval
+            metrics.inc("curfew_config_stat_total")
+            signature = self._stat()
+            if self._snapshot is None or signature != self._signature:
+                self._reload(signature)
+        return self._snapshot
+
+    def permission_index(self) -> PermissionIndex:
+        """返回当前快照对应的权限索引，只有权限相关配置变化时才会重建"""
+        snapshot = self.get()
+        if self._permission_version != self.version:
+            permissions = snapshot["permissions"]
+            key = (permissions["groups"], permissions["admin_users"])
+            if self._permission_index is None or key != self._permission_key:
+                self._permission_index = PermissionIndex(*key)
+                self._permission_key = key
+            self._permission_version = self.version
+        return self._permission_index
+
+    def invalidate(self):
+        """让下一次get立即检查文件状态"""
+        self._next_stat = 0.0
+
+    def raw(self) -> Dict[str, Any]:
+        """当前配置对应的原始TOML数据，只能读不能改"""
+        self.get()
+        return self._raw
+
+    def apply(self, mutation: Callable[[Dict[str, Any]], None]):
+        """把一次修改立即应用到内存里的配置，读配置的地方不用等写盘"""
+        raw = copy.deepcopy(self.raw())
+        mutation(raw)
+        self._raw = raw
+        self._snapshot = _freeze(_build_config(raw))
+        self.version += 1
+        metrics.configure(self._snapshot["metrics"])
+        audit_log.configure(self._snapshot["audit"])
+
+    def _stat(self) -> Tuple[int, int, int]:
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _reload(self, signature: Tuple[int, int, int]):
+        started = time.perf_counter()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                config_data = toml.load(f)
+        except Exception as e:
+            metrics.inc("curfew_config_loads_total", result="error")
+            if self._snapshot is None:
+                raise
+            # 文件被改坏的时候继续使用上一份快照，而不是让每条消息都报错
+            logger.error(f"[Command:curfew] 重新加载配置失败，继续使用旧配置: {e}")
+            self._signature = signature
+            return
+        self._snapshot = _freeze(_build_config(config_data))
+        self._raw = config_data
+        self._signature = signature
+        self.version += 1
+        metrics.configure(self._snapshot["metrics"])
+        audit_log.configure(self._snapshot["audit"])
+        metrics.inc("curfew_config_loads_total", result="ok")
+        metrics.observe("curfew_config_load_seconds", time.perf_counter() - started)
+        logger.debug(f"[Command:curfew] 配置已重新加载（版本{self.version}）")
+
+
+class ConfigWriter:
+    """把配置修改串行化、合并后原子地写回config.toml
+
+    修改先排队，等CONFIG_WRITE_DELAY秒把这段时间里的修改一次性写入：
+    重新用tomlkit读取文件（保留注释和格式）、依次应用所有修改、写入临时文件并fsync，最后rename替换原文件。
+    """
+
+    def __init__(self, path: str, store: ConfigStore, delay: float = CONFIG_WRITE_DELAY):
+        self.path = path
+        self.store = store
+        self.delay = delay
+        self._pending: List[Callable[[Dict[str, Any]], None]] = []
+        self._writing = False
+        self._lock: Optional[asyncio.Lock] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @property
+    def dirty(self) -> bool:
+        """是否还有修改没有落盘"""
+        return bool(self._pending) or self._writing
+
+    def submit(self, mutation: Callable[[Dict[str, Any]], None]):
+        """排队一次修改，稍后统一写盘"""
+        self._pending.append(mutation)
+        self._schedule(self.delay)
+
+    def _schedule(self, delay: float):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later(delay))
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        await self.flush()
+
+    async def flush(self):
+        """立即把排队中的修改写入文件"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            self._writing = True
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write, batch)
+                metrics.inc("curfew_config_writes_total", result="ok")
+                metrics.inc("curfew_config_mutations_written_total", len(batch))
+                metrics.observe("curfew_config_write_seconds", time.perf_counter() - started)
+                logger.info(f"[Command:curfew] 已将{len(batch)}项配置修改写入配置文件")
+            except Exception as e:
+                metrics.inc("curfew_config_writes_total", result="error")
+                logger.error(f"[Command:curfew] 写入配置文件失败，{CONFIG_WRITE_RETRY_DELAY}秒后重试: {e}")
+                self._pending[:0] = batch
+            finally:
+                self._writing = False
+                self.store.invalidate()
+        if self._pending:
+            self._schedule(CONFIG_WRITE_RETRY_DELAY)
+
+    def _write(self, batch: List[Callable[[Dict[str, Any]], None]]):
+        import tomlkit  # 只有写配置的时候才需要tomlkit
+
+        with open(self.path, 'r', encoding='utf-8') as f:
+            config_data = tomlkit.load(f)
+        for mutation in batch:
+            mutation(config_data)
+
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                tomlkit.dump(config_data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if hasattr(os, "O_DIRECTORY"):
+            # 让rename本身也落盘
+            dir_fd = os.open(os.path.dirname(self.path), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+
+stream_resolver = StreamResolver()
+config_store = ConfigStore(CONFIG_PATH)
+config_writer = ConfigWriter(CONFIG_PATH, config_store)
+state_store = StateStore(STATE_DB_PATH)
+retry_queue = RetryQueue(state_store)
+applied_states = AppliedStateTable(state_store)
+night_overrides = NightOverrideTable(state_store)
+cluster = ClusterCoordinator()
+audit_log = AuditLog(AUDIT_LOG_PATH)
+
+class CommandContext(NamedTuple):
+    """一次/curfew指令解析出来的参数"""
+    operation_type: str
+    action_type: Optional[str]
+    value: Optional[str]
+    group_id: Optional[str]  # 群聊里是群号，私聊里是None
+    target_stream: str
+
+
 class CurfewCommand(BaseCommand):
     command_name = "curfew"
     command_description = "启用或者禁用宵禁"
@@ -28,6 +1727,32 @@ class CurfewCommand(BaseCommand):
     
     _curfew_task: Optional[asyncio.Task] = None
     _is_curfew_active: bool = False
+    _wakeup_event: Optional[asyncio.Event] = None
+    _rate_limiter: Optional[TokenBucket] = None
+    _retry_task: Optional[asyncio.Task] = None
+    _resume_task: Optional[asyncio.Task] = None
+    _draining: bool = False  # 正在关闭：不再开始新的群操作
+    _denial_replies: Dict[Tuple[str, Optional[str]], float] = {}  # (用户, 群) → 上次回复"权限不足"的时间
+
+    # 子命令分发表，类加载时构建一次
+    _OPERATIONS: Dict[str, Callable[["CurfewCommand", CommandContext], Awaitable[Any]]] = {
+        "true": lambda self, ctx: self._start_curfew_task(ctx.target_stream),
+        "false": lambda self, ctx: self._handle_disable(ctx.target_stream),
+        "time": lambda self, ctx: self._handle_time_list(ctx.action_type, ctx.group_id, ctx.target_stream),
+        "start_time": lambda self, ctx: self._handle_time_config(ctx.operation_type, ctx.action_type, ctx.value, ctx.group_id, ctx.target_stream),
+        "end_time": lambda self, ctx: self._handle_time_config(ctx.operation_type, ctx.action_type, ctx.value, ctx.group_id, ctx.target_stream),
+        "weekend_start_time": lambda self, ctx: self._handle_time_config(ctx.operation_type, ctx.action_type, ctx.value, ctx.group_id, ctx.target_stream),
+        "weekend_end_time": lambda self, ctx: self._handle_time_config(ctx.operation_type, ctx.action_type, ctx.value, ctx.group_id, ctx.target_stream),
+        "tonight": lambda self, ctx: self._handle_tonight(ctx.action_type, ctx.value, ctx.group_id, ctx.target_stream),
+        "timezone": lambda self, ctx: self._handle_timezone_config(ctx.action_type, ctx.value, ctx.group_id, ctx.target_stream),
+        "permission_group": lambda self, ctx: self._handle_permission_group(ctx.action_type, ctx.value, ctx.group_id, ctx.target_stream),
+        "stats": lambda self, ctx: self._handle_stats(ctx.action_type, ctx.target_stream),
+        "status": lambda self, ctx: self._handle_status(ctx.action_type, ctx.group_id, ctx.target_stream),
+    }
+    # 会改变宵禁状态、需要写进操作记录的子命令（修改配置的由set_config单独记录）
+    _AUDITED_COMMANDS = frozenset({
+        ("true", None), ("false", None), ("tonight", "skip"), ("tonight", "extend"), ("tonight", "clear"),
+    })
 
     def __init__(self, message, plugin_config: dict = None):
         super().__init__(message,plugin_config)
@@ -40,47 +1765,54 @@ class CurfewCommand(BaseCommand):
             sender = self.message.message_info.user_info
             group = self.message.message_info.group_info
             operation_type = self.matched_groups.get("operation_type")
-            action_type = self.matched_groups.get("action_type")
-            value = self.matched_groups.get("value")
             target_stream = self.message.chat_stream.stream_id
-            
-            if group == None:  #首先确定是不是群聊环境
-                target = None
-                target_id = sender.user_id  # 不是群聊环境就把id换成私聊的QQ号
-            else:
-                target = group.group_id
-                target_id = group.group_id  # 是群聊就把id设置为QQ群号
+            target = None if group == None else group.group_id  # 私聊环境下没有群号
 
-            if not self._check_group_permission(target) and not group == None: # 检查在不在生效群聊里，当然，必须是群聊环境，但也能透传私聊
+            # 先用缓存的权限索引拦下无权调用，这一步不读文件、不构建任何东西
+            permission_index = self._permission_index()
+            if target is not None and not permission_index.has_group(target): # 检查在不在生效群聊里，当然，必须是群聊环境，但也能透传私聊
+                metrics.inc("curfew_commands_rejected_total", reason="group")
+                return False,"", True
+            
+            if not permission_index.is_admin(sender.user_id): # 检查个人权限，不是管理用户就直接截断命令
+                metrics.inc("curfew_commands_rejected_total", reason="user")
+                if self._should_reply_denial(sender.user_id, target):
+                    await self.send_message(
+                        "权限不足，你无权使用此命令", 
+                        target_stream
+                    )
                 return False,"", True
 
             if group == None and (operation_type == "true" or operation_type == "false"):
                 await self.send_message("抱歉，私聊情况下，'true'或者'false'参数都是被禁用的", target_stream) # 做一个提醒，告诉私聊的人用不了/curfew true或者false
                 return False,"", True
-            
-            if not self._check_person_permission(sender.user_id): # 检查个人权限，不是管理用户就直接截断命令
-                await self.send_message(
-                    "权限不足，你无权使用此命令", 
-                    target_stream
-                )
-                return False,"", True
         
-            # 使用字典映射替代长串if-elif判断
-            operation_map = {
-                "true": lambda: self._start_curfew_task(target_stream),
-                "false": lambda: self._handle_disable(target_stream),
-                "time": lambda: self._handle_time_list(action_type, target_stream),
-                "start_time": lambda: self._handle_time_config(operation_type, action_type, value, target_id, target_stream),
-                "end_time": lambda: self._handle_time_config(operation_type, action_type, value, target_id, target_stream),
-                "permission_group": lambda: self._handle_permission_group(action_type, value, target_id, target_stream)
-            }
-            
-            if operation_type in operation_map:
-                await operation_map[operation_type]()
+            # 使用类级别的分发表替代长串if-elif判断
+            handler = self._OPERATIONS.get(operation_type)
+            if handler is not None:
+                ctx = CommandContext(
+                    operation_type,
+                    self.matched_groups.get("action_type"),
+                    self.matched_groups.get("value"),
+                    target,
+                    target_stream,
+                )
+                started = time.perf_counter()
+                try:
+                    await handler(self, ctx)
+                    if (operation_type, ctx.action_type) in self._AUDITED_COMMANDS:
+                        audit_log.record(
+                            "command", self._actor(), None if target is None else _normalize_id(target),
+                            operation=operation_type, action=ctx.action_type, value=ctx.value,
+                        )
+                finally:
+                    metrics.inc("curfew_commands_total", operation=operation_type)
+                    metrics.observe("curfew_command_seconds", time.perf_counter() - started, operation=operation_type)
+                    metrics.maybe_export()
                 return True, "", True
             else:
                 await self.send_message(
-                    "别乱填参数啊，可以用的有'true'，'false'，'time'，'start_time'，'end_time'，'permission_group'", 
+                    "别乱填参数啊，可以用的有'true'，'false'，'time'，'start_time'，'end_time'，'weekend_start_time'，'weekend_end_time'，'tonight'，'timezone'，'permission_group'，'stats'，'status'", 
                     target_stream
                 )
                 logger.error(f"{self.log_prefix} 参数错误")
@@ -90,27 +1822,89 @@ class CurfewCommand(BaseCommand):
             logger.error(f"{self.log_prefix} 执行错误: {e}")
             return False, f"执行失败: {str(e)}", True
 
+    def _should_reply_denial(self, user_id: Any, group_id: Optional[str]) -> bool:
+        """同一个人在同一个地方刷指令时，冷却时间内只回复一次“权限不足”"""
+        cooldown = self._load_config()["permissions"]["denial_reply_cooldown"]
+        if not cooldown or cooldown <= 0:
+            return True
+        now = clock.monotonic()
+        replies = CurfewCommand._denial_replies
+        key = (_normalize_id(user_id), group_id)
+        last = replies.get(key)
+        if last is not None and now - last < cooldown:
+            metrics.inc("curfew_denial_replies_suppressed_total")
+            return False
+        if len(replies) >= 4096:
+            # 顺手清理已经过了冷却时间的记录，防止字典无限增长
+            for stale in [k for k, t in replies.items() if now - t >= cooldown]:
+                del replies[stale]
+        replies[key] = now
+        return True
+
     async def _handle_disable(self, target_stream: str) -> Tuple[bool, str]:
         """处理禁用宵禁"""
+        # 多实例时只有最后一个关闭的实例负责解禁，否则这些群会交给还开着的实例继续管理
+        groups = self._permission_index().group_list if cluster.is_last_member() else []
         await self._stop_curfew_task(target_stream)
-        await self._apply_curfew_state(False, self._load_config(), send_message=False)
+        if groups:
+            await self._apply_curfew_state(False, self._load_config(), send_message=False, groups=groups, actor=self._actor())
         return True
 
-    async def _handle_time_list(self, action_type: str, target_stream:str) -> Tuple[bool, str]:
-        """列出权限组列表"""
+    async def _handle_time_list(self, action_type: str, group_id: Optional[str], target_stream:str) -> Tuple[bool, str]:
+        """列出宵禁时段，群聊里只列出本群的"""
         if action_type == "list":
             config = self._load_config()
-            start_time = config["curfew"].get("start_time", "23:00")
-            end_time = config["curfew"].get("end_time", "6:00")
-            await self.send_message(f"当前设置的宵禁时间是{start_time}~{end_time}哦", target_stream)
+            if group_id is not None:
+                group_id = _normalize_id(group_id)
+                schedule = build_group_schedules(config, [group_id]).get(group_id)
+                if schedule is None:
+                    await self.send_message("本群的宵禁时间配置有误，请检查配置文件", target_stream)
+                    return False
+                scope = "本群单独设置的" if group_id in config["schedules"] else "本群当前的"
+                offset = group_offset(group_id, config["curfew"]["spread_seconds"])
+                await self.send_message(f"{scope}宵禁时间是{schedule.describe(offset)}哦", target_stream)
+            else:
+                curfew_config = config["curfew"]
+                spread_seconds = curfew_config["spread_seconds"]
+                schedule = build_group_schedules(config, [NightOverrideTable.GLOBAL], with_overrides=False).get(NightOverrideTable.GLOBAL)
+                if schedule is None:
+                    await self.send_message("宵禁时间配置有误，请检查配置文件", target_stream)
+                    return False
+                lines = [f"当前设置的宵禁时间是{schedule.describe()}哦"]
+                today = datetime.fromtimestamp(clock.time(), schedule.tzinfo).date().isoformat()
+                upcoming = [
+                    f"{day}: " + ("不宵禁" if skip else f"{start or '照常'}~{end or '照常'}")
+                    for day, skip, start, end in schedule.exceptions if day >= today
+                ]
+                if upcoming:
+                    lines.append("接下来的例外日期：")
+                    lines.extend(upcoming)
+                if spread_seconds:
+                    lines.append(f"各群会在之后的{spread_seconds}秒内错峰执行，在群里查询可以看到本群的实际时间")
+                groups = self._permission_index().group_list
+                overrides = [
+                    f"{gid}: {schedule.describe(group_offset(gid, spread_seconds))}"
+                    for gid, schedule in build_group_schedules(config, groups).items()
+                    if gid in config["schedules"]
+                ]
+                if overrides:
+                    lines.append("单独设置了宵禁时间的群：")
+                    lines.extend(overrides)
+                await self.send_message("\n".join(lines), target_stream)
             logger.info(f"{self.log_prefix} 已列出宵禁时段")
             return True
+        elif action_type == "reset":
+            if group_id is None:
+                await self.send_message("私聊情况下没有可以重置的群设置哦", target_stream)
+                return False
+            await self.set_config("time", action_type, None, group_id, target_stream)
+            return True
         else:
-            await self.send_message(f"{action_type}不是可用的参数，目前只有'list'这一个参数哦", target_stream)
+            await self.send_message(f"{action_type}不是可用的参数，目前只有'list'和'reset'这两个参数哦", target_stream)
             return False
 
-    async def _handle_time_config(self, operation_type, action_type: str, value: str, group_id: str, target_stream:str) -> Tuple[bool, str]:
-        """处理时间配置"""
+    async def _handle_time_config(self, operation_type, action_type: str, value: str, group_id: Optional[str], target_stream:str) -> Tuple[bool, str]:
+        """处理时间配置，群聊里修改的是本群的时段，私聊里修改的是全局时段"""
         if action_type != "set":
             await self.send_message(f"{action_type}不是可用的参数，目前只有'set'这一个参数哦", target_stream)
             return False
@@ -127,15 +1921,177 @@ class CurfewCommand(BaseCommand):
         if value == "24:00":
             value = "00:00"
         
-        set_text = "宵禁开始时间" if operation_type == "start_time" else "宵禁结束时间"
+        set_text = {
+            "start_time": "宵禁开始时间",
+            "end_time": "宵禁结束时间",
+            "weekend_start_time": "周末宵禁开始时间",
+            "weekend_end_time": "周末宵禁结束时间",
+        }[operation_type]
+        if group_id is not None:
+            set_text = "本群的" + set_text
         
-        await self.set_config(operation_type, action_type, value, group_id)
+        await self.set_config(operation_type, action_type, value, group_id, target_stream)
         message = f"不能识别24:00哦，已经给你改好了，将{set_text}变更为{value}" if value == "00:00" else f"已将{set_text}变更为{value}"
         await self.send_message(message, target_stream)
         logger.info(f"{self.log_prefix} 已将{set_text}变更为{value}")
         return True
 
-    async def _handle_permission_group(self, action_type: str, value: str, group_id: str, target_stream:str) -> Tuple[bool, str]:
+    async def _handle_timezone_config(self, action_type: str, value: str, group_id: Optional[str], target_stream:str) -> Tuple[bool, str]:
+        """处理时区配置，群聊里修改的是本群的时区，私聊里修改的是全局时区"""
+        if action_type != "set":
+            await self.send_message(f"{action_type}不是可用的参数，目前只有'set'这一个参数哦", target_stream)
+            return False
+
+        if value == None:
+            await self.send_message("别什么都不填啊，这里填时区啊，比如Asia/Shanghai", target_stream)
+            return False
+
+        value = value.strip()
+        try:
+            _load_timezone(value)
+        except Exception:
+            await self.send_message(f"{value}不是可用的时区哦，要填Asia/Shanghai这种格式的", target_stream)
+            return False
+
+        set_text = "本群的时区" if group_id is not None else "宵禁时区"
+        await self.set_config("timezone", action_type, value, group_id, target_stream)
+        await self.send_message(f"已将{set_text}变更为{value}", target_stream)
+        logger.info(f"{self.log_prefix} 已将{set_text}变更为{value}")
+        return True
+
+    async def _handle_tonight(self, action_type: Optional[str], value: Optional[str], group_id: Optional[str], target_stream: str) -> bool:
+        """临时调整今晚的宵禁：skip取消，extend延长若干分钟，clear撤销调整，不带参数时查看今晚实际的时段
+
+        群聊里只调整本群，私聊里调整所有群。"今晚"指正在进行的或者接下来最近的一晚。
+        """
+        config = self._load_config()
+        if group_id is None:
+            scope, scope_text, offset = NightOverrideTable.GLOBAL, "所有群", 0
+        else:
+            scope, scope_text = _normalize_id(group_id), "本群"
+            offset = group_offset(scope, config["curfew"]["spread_seconds"])
+        # 用不含临时调整的日历确定今晚是哪一晚，这样重复执行不会顺延到明晚
+        base = build_group_schedules(config, [scope], with_overrides=False).get(scope)
+        night = base.night_at(clock.time(), offset) if base is not None else None
+        if night is None:
+            await self.send_message(f"{scope_text}接下来都没有宵禁，没什么可以调整的", target_stream)
+            return False
+        day = night[0]
+        night_text = day.isoformat()
+
+        if action_type is None or action_type == "list":
+            schedule = build_group_schedules(config, [scope]).get(scope)
+            window = schedule.window(day) if schedule is not None else None
+            if window is None:
+                await self.send_message(f"{scope_text}{night_text}晚上不宵禁", target_stream)
+            else:
+                await self.send_message(f"{scope_text}{night_text}晚上的宵禁时间是{self._format_window(window, offset, schedule.tzinfo)}", target_stream)
+            return True
+        elif action_type == "skip":
+            night_overrides.set(scope, night_text, True, 0)
+            message = f"已取消{scope_text}{night_text}晚上的宵禁"
+        elif action_type == "extend":
+            if value is None or not value.strip().isdigit() or not 0 < int(value) <= MAX_EXTEND_MINUTES:
+                await self.send_message(f"要填延长多少分钟哦，1到{MAX_EXTEND_MINUTES}之间", target_stream)
+                return False
+            night_overrides.set(scope, night_text, False, int(value))
+            message = f"已将{scope_text}{night_text}晚上的宵禁延长{int(value)}分钟"
+        elif action_type == "clear":
+            if not night_overrides.clear(scope, night_text):
+                await self.send_message(f"{scope_text}{night_text}晚上本来就没有临时调整哦", target_stream)
+                return False
+            message = f"已撤销{scope_text}{night_text}晚上的临时调整"
+        else:
+            await self.send_message(f"{action_type}不是可用的参数，目前只有'skip'，'extend'，'clear'，'list'这几个参数哦", target_stream)
+            return False
+
+        night_overrides.prune((day - timedelta(days=2)).isoformat())
+        self._notify_config_changed()
+        await self.send_message(message, target_stream)
+        logger.info(f"{self.log_prefix} {message}")
+        return True
+
+    @staticmethod
+    def _format_window(window: Tuple[float, float], offset: int, tzinfo: Optional[ZoneInfo]) -> str:
+        start = datetime.fromtimestamp(window[0] + offset, tzinfo)
+        end = datetime.fromtimestamp(window[1] + offset, tzinfo)
+        return f"{start.strftime('%m-%d %H:%M')}~{end.strftime('%m-%d %H:%M')}"
+
+    async def _handle_status(self, action_type: Optional[str], group_id: Optional[str], target_stream: str) -> bool:
+        """查看某个群现在是否在宵禁、从什么时候开始、最近一次操作是否成功，只查内存里的状态和记录
+
+        群聊里不带参数查本群，带群号查指定的群；私聊里不带参数查看总体情况。
+        """
+        if action_type is not None:
+            if not re.match(r"^[1-9]\d{4,10}$", action_type):
+                await self.send_message(f"不对，你确定{action_type}是一个群号吗？", target_stream)
+                return False
+            group_id = action_type
+        tzinfo = _load_timezone(self._load_config()["curfew"]["timezone"])
+
+        def when(ts: float) -> str:
+            return datetime.fromtimestamp(ts, tzinfo).strftime("%m-%d %H:%M:%S")
+
+        if group_id is None:
+            permission_index = self._permission_index()
+            muted = sum(1 for gid in permission_index.group_list if applied_states.get(gid))
+            lines = [
+                f"宵禁功能{'开启' if type(self)._curfew_task is not None and not type(self)._curfew_task.done() else '关闭'}中",
+                f"正在宵禁的群：{muted}/{len(permission_index.group_list)}",
+            ]
+            if len(retry_queue):
+                lines.append(f"等待重试的群：{len(retry_queue)}")
+                for entry in sorted(retry_queue.entries.values(), key=lambda item: item.next_attempt)[:5]:
+                    lines.append(f"  {entry.group_id}: 第{entry.attempts}次失败，{entry.last_error}")
+            last = audit_log.latest("transition")
+            if last is not None:
+                lines.append(f"最近一次切换：{when(last['ts'])} {'禁言' if last['muted'] else '解禁'}{last['groups']}个群")
+            await self.send_message("\n".join(lines), target_stream)
+            return True
+
+        group_id = _normalize_id(group_id)
+        state = applied_states.get(group_id)
+        since = applied_states.since(group_id)
+        if state is None:
+            lines = [f"群{group_id}还没有操作记录"]
+        else:
+            lines = [f"群{group_id}{'正在宵禁' if state else '没有宵禁'}" + (f"，自{when(since)}起" if since else "")]
+        if not self._permission_index().has_group(group_id):
+            lines.append("（这个群不在生效群聊里）")
+        last = audit_log.last(group_id, "group")
+        if last is not None:
+            result = "成功" if last["ok"] else f"失败：{last['error']}"
+            lines.append(f"最近一次操作：{when(last['ts'])} {'禁言' if last['muted'] else '解禁'}{result}（{last['actor']}）")
+        entry = retry_queue.entries.get(group_id)
+        if entry is not None:
+            lines.append(
+                f"等待重试：{'禁言' if entry.enable else '解禁'}已经失败{entry.attempts}次，"
+                f"{max(entry.next_attempt - clock.time(), 0):.0f}秒后重试，上次错误：{entry.last_error}"
+            )
+        elif last is None and state is not None:
+            lines.append("最近的操作记录已经不在内存里了，需要的话可以翻curfew_audit.jsonl")
+        await self.send_message("\n".join(lines), target_stream)
+        return True
+
+    async def _handle_stats(self, action_type: Optional[str], target_stream: str) -> bool:
+        """查看或清空运行统计"""
+        if not metrics.enabled:
+            await self.send_message("统计功能没有开启哦，在配置文件的[metrics]里把enabled改成true就行", target_stream)
+            return False
+        if action_type == "reset":
+            metrics.reset()
+            await self.send_message("已清空统计数据", target_stream)
+            return True
+        if action_type is not None:
+            await self.send_message(f"{action_type}不是可用的参数，目前只有'reset'这一个参数哦", target_stream)
+            return False
+        lines = metrics.summary_lines()
+        metrics.export()
+        await self.send_message("宵禁插件运行统计：\n" + ("\n".join(lines) if lines else "还没有任何数据"), target_stream)
+        logger.info(f"{self.log_prefix} 已列出运行统计")
+        return True
+
+    async def _handle_permission_group(self, action_type: str, value: str, group_id: Optional[str], target_stream:str) -> Tuple[bool, str]:
         """处理权限组配置"""
         action_handlers = {
             "add": self._handle_group_add,
@@ -178,77 +2134,74 @@ class CurfewCommand(BaseCommand):
 
     async def _handle_group_list(self, group_id: str, value: str, target_stream:str) -> Tuple[bool, str]:
         """列出权限组列表"""
-        config = self._load_config()
-        allowed_groups = config["permissions"].get("groups", [])
+        allowed_groups = self._permission_index().group_list
         result = "宵禁插件生效的QQ群列表：\n" + "\n".join(allowed_groups)
         await self.send_message(result, target_stream)
         logger.info(f"{self.log_prefix} 已列出所有生效群聊")
         return True
 
-    def _check_group_permission(self, group_id: str) -> bool:
-        """权限检查逻辑"""
-        config = self._load_config()
-        allowed_groups = config["permissions"].get("groups", [])
-        return group_id in allowed_groups
+    def _actor(self) -> str:
+        """写进操作记录的触发者：发指令的人的QQ号，后台任务则是system"""
+        if self.message is None:
+            return "system"
+        return _normalize_id(self.message.message_info.user_info.user_id)
 
-    def _check_person_permission(self, user_id: str) -> bool:
-        """权限检查逻辑"""
-        config = self._load_config()
-        admin_users = config["permissions"].get("admin_users", [])
-        return user_id in admin_users
+    def _permission_index(self) -> PermissionIndex:
+        """获取当前配置的权限索引"""
+        try:
+            return config_store.permission_index()
+        except Exception as e:
+            logger.error(f"{self.log_prefix} 加载配置失败: {e}")
+            raise
     
-    def _load_config(self) -> Dict[str, Any]:
-        """从同级目录的config.toml文件直接加载配置"""
+    def _load_config(self) -> Mapping[str, Any]:
+        """获取同级目录config.toml的共享配置快照"""
         try:
-            # 获取当前文件所在目录
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            config_path = os.path.join(script_dir, "config.toml")
-            
-            # 读取并解析TOML配置文件
-            with open(config_path, 'r', encoding='utf-8') as f:
-                config_data = toml.load(f)
-            
-            # 构建配置字典，使用get方法安全访问嵌套值
-            config = {
-                "curfew": {
-                    "start_time": config_data.get("curfew", {}).get("start_time", "23:00"),
-                    "end_time": config_data.get("curfew", {}).get("end_time", "06:00"),
-                    "check_interval": config_data.get("curfew", {}).get("check_interval", 60)
-                },
-                "messages": {
-                    "mute_message": config_data.get("messages", {}).get("mute_message", "宵禁时间到咯"),
-                    "unmute_message": config_data.get("messages", {}).get("unmute_message", "宵禁时间结束咯")
-                },
-                "permissions": {
-                    "admin_users": config_data.get("permissions", {}).get("admin_users", []),
-                    "groups": config_data.get("permissions", {}).get("groups", [])
-                }
-            }
-            return config
+            return config_store.get()
         except Exception as e:
             logger.error(f"{self.log_prefix} 加载配置失败: {e}")
             raise
 
     async def set_config(self, operation_type: str, action_type: str, value: str, group_id: str, target_stream):
-        """使用tomlkit修改配置文件，保持注释和格式"""
+        """修改配置：内存里的配置立刻生效，写回文件交给config_writer合并后原子写入（用tomlkit保持注释和格式）"""
         try:
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            config_path = os.path.join(script_dir, "config.toml")
-            
-            # 使用tomlkit读取，保持格式和注释
-            with open(config_path, 'r', encoding='utf-8') as f:
-                config_data = tomlkit.load(f)
+            config_data = config_store.raw()
             
-            if operation_type in ["start_time", "end_time"]:
-                config_data["curfew"][operation_type] = value
+            if operation_type in SCHEDULE_KEYS:
+                group_key = None if group_id is None else _normalize_id(group_id)
+
+                def mutation(doc, key=operation_type, group_key=group_key, value=value):
+                    if group_key is None:
+                        doc.setdefault("curfew", {})[key] = value
+                    else:
+                        doc.setdefault("schedules", {}).setdefault(group_key, {})[key] = value
+            elif operation_type == "time" and action_type == "reset":
+                group_key = _normalize_id(group_id)
+                if group_key not in config_data.get("schedules", {}):
+                    await self.send_message("本群本来就在使用全局的宵禁时间哦", target_stream)
+                    return
+
+                def mutation(doc, group_key=group_key):
+                    doc.get("schedules", {}).pop(group_key, None)
+                await self.send_message("已将本群的宵禁时间恢复为全局设置", target_stream)
+                logger.info(f"{self.log_prefix} 已将群聊{group_key}的宵禁时间恢复为全局设置")
             elif operation_type == "permission_group":
-                groups_list = config_data["permissions"]["groups"]
-                if action_type == "add" and value not in groups_list:
-                    groups_list.append(value)
+                groups_list = config_data.get("permissions", {}).get("groups", [])
+                exists = any(_normalize_id(item) == value for item in groups_list)
+                if action_type == "add" and not exists:
+                    def mutation(doc, value=value):
+                        groups = doc.setdefault("permissions", {}).setdefault("groups", [])
+                        if not any(_normalize_id(item) == value for item in groups):
+                            # toml库要求数组元素类型一致，群号原本写成整数的就继续写整数
+                            int_ids = groups and all(isinstance(item, int) for item in groups)
+                            groups.append(int(value) if int_ids else value)
                     await self.send_message(f"已将群聊{value}添加到生效群聊中", target_stream)
                     logger.info(f"{self.log_prefix} 已将群聊{value}添加到生效群聊中")
-                elif action_type == "remove" and value in groups_list:
-                    groups_list.remove(value)
+                elif action_type == "remove" and exists:
+                    def mutation(doc, value=value):
+                        groups = doc.get("permissions", {}).get("groups", [])
+                        for item in [item for item in groups if _normalize_id(item) == value]:
+                            groups.remove(item)
                     await self.send_message(f"已将群聊{value}从生效群聊中移除", target_stream)
                     logger.info(f"{self.log_prefix} 已将群聊{value}从生效群聊中移除")
                 else:
@@ -256,10 +2209,23 @@ class CurfewCommand(BaseCommand):
                     await self.send_message(message, target_stream)
                     logger.info(f"{self.log_prefix} {message}")
                     return
+            else:
+                raise ValueError(f"未知的配置操作: {operation_type} {action_type}")
             
-            # 使用tomlkit写入，保持格式和注释
-            with open(config_path, 'w', encoding='utf-8') as f:
-                tomlkit.dump(config_data, f)
+            if operation_type == "permission_group":
+                stream_resolver.invalidate(value)
+            config_store.apply(mutation)
+            config_writer.submit(mutation)
+            # 增删生效群聊记在被增删的那个群名下，其他修改记在发指令的群名下（私聊时不属于任何群）
+            if operation_type == "permission_group":
+                audit_group = value
+            else:
+                audit_group = None if group_id is None else _normalize_id(group_id)
+            audit_log.record(
+                "config", self._actor(), audit_group,
+                operation=operation_type, action=action_type, value=value,
+            )
+            self._notify_config_changed()
                 
         except Exception as e:
             logger.error(f"{self.log_prefix} 更新配置文件失败: {e}")
@@ -269,69 +2235,390 @@ class CurfewCommand(BaseCommand):
         """单独构建的的一个发消息方法"""
         await send_api.text_to_stream(content, target_stream)     
 
-    def _is_in_curfew_time(self, config: Dict[str, Any]) -> bool:
-        """检查是否在宵禁时间"""
-        try:
-            now = datetime.now().time()
-            curfew_config = config["curfew"]
-            start_time = datetime.strptime(curfew_config["start_time"], "%H:%M").time()
-            end_time = datetime.strptime(curfew_config["end_time"], "%H:%M").time()
-            
-            if start_time <= end_time:
-                # 当天内的时间段
-                return start_time <= now <= end_time
-            else:
-                # 跨天的时间段
-                return now >= start_time or now <= end_time
-        except Exception as e:
-            logger.error(f"{self.log_prefix} 解析时间配置失败: {e}")
-            return False
+    async def _apply_curfew_state(self, should_mute: bool, config: Dict[str, Any], send_message: bool = True, first: bool=True, groups: Optional[Iterable[str]] = None, actor: str = "scheduler", sharded: bool = False) -> DispatchReport:
+        """对指定的群聊开始应用宵禁，不指定groups时对所有生效群聊操作，actor会写进操作记录
 
-    async def _apply_curfew_state(self, should_mute: bool, config: Dict[str, Any], send_message: bool = True, first: bool=True):
-        """对指定的群聊开始应用宵禁"""
-        target_groups = config["permissions"]["groups"]
+        sharded表示这些群是按分片分给本实例的，每次调用接口前都会确认这个群还归本实例，
+        分发途中被别的实例接手的群直接跳过，由新的主人按共享库里的状态接着处理。
+        """
+        action = "宵禁" if should_mute else "解除宵禁"
+        # 不指定groups时只处理本实例负责的那部分群
+        if groups is None:
+            target_groups = cluster.shard(self._permission_index().group_list)
+            sharded = True
+        else:
+            target_groups = list(groups)
         if not target_groups:
             logger.warning(f"{self.log_prefix} 未配置目标群组，跳过操作")
-            return
+            return DispatchReport(action, [], 0.0)
 
         messages = config["messages"]
         message = messages["mute_message" if should_mute else "unmute_message"]
+        dispatch_config = config["dispatch"]
+        rate_limiter = type(self)._get_rate_limiter(dispatch_config)
+        stream_resolver.configure(dispatch_config["stream_cache_ttl"], dispatch_config["stream_negative_ttl"])
+
+        def check_owner(group_id: str):
+            # 排队等令牌的时候存活实例可能已经变了
+            if sharded and not cluster.owns(group_id):
+                raise GroupHandedOffError(f"群{group_id}已经交给其他实例")
+
+        async def apply_to_group(group_id: str):
+            target_stream = stream_resolver.resolve(group_id)
+            # 同一个群里先发消息再禁言，两次调用的令牌一起拿，发完消息后不用再排队，
+            # 免得排队期间这个群被别的实例接手，新主人又把提示消息发一遍
+            send_notice = (first or should_mute) and send_message
+            await rate_limiter.acquire(2 if send_notice else 1)
+            if send_notice:
+                check_owner(group_id)
+                started = time.perf_counter()
+                await send_api.text_to_stream(message, target_stream)
+                metrics.observe("curfew_send_seconds", time.perf_counter() - started, kind="message")
+            check_owner(group_id)
+            started = time.perf_counter()
+            await send_api.command_to_stream(
+                {"name": "GROUP_WHOLE_BAN", "args": {"enable": should_mute}},
+                target_stream
+            )
+            metrics.observe("curfew_send_seconds", time.perf_counter() - started, kind="command")
+
+        def handle_result(result: GroupResult):
+            if result.skipped:
+                return  # 留在pending里，关闭时会记成未完成
+            if result.handed_off:
+                applied_states.settle(result.group_id)
+                logger.info(f"{self.log_prefix} {action}操作跳过: {result.group_id} - {result.error}")
+                return
+            audit_log.record(
+                "group", actor, result.group_id, muted=should_mute, ok=result.ok,
+                error=result.error, elapsed=round(result.elapsed, 3),
+            )
+            metrics.inc("curfew_group_operations_total", result="ok" if result.ok else "unresolved" if result.unresolved else "failed")
+            if result.ok:
+                retry_queue.discard(result.group_id)
+                applied_states.record(result.group_id, should_mute, clock.time())
+                logger.info(f"{self.log_prefix} {action}操作成功: {result.group_id}（{result.elapsed:.2f}秒）")
+            else:
+                if result.unresolved:
+                    logger.warning(f"{self.log_prefix} {action}操作跳过: {result.group_id} - {result.error}")
+                else:
+                    stream_resolver.invalidate(result.group_id)  # 缓存的stream_id可能已经失效
+                    logger.error(f"{self.log_prefix} {action}操作失败: {result.group_id} - {result.error}")
+                applied_states.settle(result.group_id)
+                self._schedule_retry(result.group_id, should_mute, result.error, config)
+
+        started = clock.monotonic()
+        applied_states.begin(target_groups, should_mute)
+        results = await dispatch_to_groups(
+            target_groups, apply_to_group, dispatch_config["max_concurrency"], type(self)._is_draining, handle_result
+        )
+        report = DispatchReport(action, results, clock.monotonic() - started)
+        metrics.observe("curfew_fanout_seconds", report.elapsed, action="mute" if should_mute else "unmute")
+        logger.info(f"{self.log_prefix} {report.summary()}")
+        return report
+
+    def _schedule_retry(self, group_id: str, should_mute: bool, error: Optional[str], config: Mapping[str, Any]):
+        """把失败的禁言/解禁操作放进重试队列"""
+        entry = retry_queue.schedule(group_id, should_mute, error, config["retry"], clock.time())
         action = "宵禁" if should_mute else "解除宵禁"
+        if entry is None:
+            logger.error(f"{self.log_prefix} {action}操作多次重试仍然失败，已放弃: {group_id}")
+            return
+        logger.info(f"{self.log_prefix} {action}操作将在{entry.next_attempt - clock.time():.0f}秒后第{entry.attempts}次重试: {group_id}")
+        type(self)._ensure_retry_worker()
 
-        for group_id in target_groups:
-            try:
-                target_stream = chat_api.get_stream_by_group_id(group_id).stream_id
-                if (first or should_mute) and send_message:
-                    await send_api.text_to_stream(message, target_stream)
-                await send_api.command_to_stream(
-                    {"name": "GROUP_WHOLE_BAN", "args": {"enable": should_mute}},
-                    target_stream
-                )
-                logger.info(f"{self.log_prefix} {action}操作成功: {group_id}")
-            except Exception as e:
-                logger.error(f"{self.log_prefix} {action}操作失败: {group_id} - {e}")
+    async def _retry_worker_task(self):
+        """重试队列的后台任务，独立于宵禁调度运行，不会拖慢正常的切换"""
+        logger.info(f"{self.log_prefix} 重试任务启动")
+        event = retry_queue.changed_event()
+        try:
+            while len(retry_queue) and not type(self)._draining:
+                due = retry_queue.pop_due(clock.time())
+                if due:
+                    await self._run_retries(due)
+                    continue
+                next_due = retry_queue.next_due()
+                event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=max(next_due - clock.time(), 0.0))
+                except asyncio.TimeoutError:
+                    pass
+            if type(self)._draining:
+                logger.info(f"{self.log_prefix} 插件正在关闭，重试任务结束（还有{len(retry_queue)}个群待重试）")
+            else:
+                logger.info(f"{self.log_prefix} 重试队列已清空，重试任务结束")
+        except asyncio.CancelledError:
+            logger.info(f"{self.log_prefix} 重试任务已取消")
+            raise
+
+    async def _run_retries(self, entries: List[RetryEntry]):
+        """执行一批到期的重试"""
+        config = self._load_config()
+        permission_index = self._permission_index()
+        rate_limiter = type(self)._get_rate_limiter(config["dispatch"])
+        by_group: Dict[str, RetryEntry] = {}
+        for entry in entries:
+            if not cluster.owns(entry.group_id):
+                # 这个群已经分给别的实例了，由它负责
+                retry_queue.discard(entry.group_id)
+                continue
+            if entry.enable and not permission_index.has_group(entry.group_id):
+                # 已经不在生效群聊里的群不再补禁言，但解禁还是要补上
+                retry_queue.discard(entry.group_id)
+                continue
+            by_group[entry.group_id] = entry
+
+        async def retry_group(group_id: str):
+            entry = by_group[group_id]
+            if not retry_queue.is_current(entry):
+                return
+            target_stream = stream_resolver.resolve(group_id)
+            await rate_limiter.acquire()
+            if not cluster.owns(group_id):
+                raise GroupHandedOffError(f"群{group_id}已经交给其他实例")
+            if self._desired_state(group_id, config, clock.time()) != entry.enable:
+                # 排队重试期间时段已经过去了（或者今晚被取消了），不再补发过时的指令
+                retry_queue.discard(group_id)
+                logger.info(f"{self.log_prefix} 目标状态已经变了，放弃过时的重试: {group_id}")
+                return
+            await send_api.command_to_stream(
+                {"name": "GROUP_WHOLE_BAN", "args": {"enable": entry.enable}},
+                target_stream
+            )
+
+        results = await dispatch_to_groups(list(by_group), retry_group, config["dispatch"]["max_concurrency"], type(self)._is_draining)
+        for result in results:
+            if result.skipped:
+                continue  # 重试记录已经持久化，下次启动接着重试
+            entry = by_group[result.group_id]
+            if not retry_queue.is_current(entry):
+                continue  # 重试期间已经有了更新的目标状态
+            if result.handed_off:
+                retry_queue.discard(result.group_id)
+                continue
+            audit_log.record(
+                "group", "retry", result.group_id, muted=entry.enable, ok=result.ok,
+                error=result.error, elapsed=round(result.elapsed, 3), attempt=entry.attempts,
+            )
+            action = "宵禁" if entry.enable else "解除宵禁"
+            if result.ok:
+                retry_queue.discard(result.group_id)
+                applied_states.record(result.group_id, entry.enable, clock.time())
+                logger.info(f"{self.log_prefix} {action}重试成功: {result.group_id}（第{entry.attempts}次）")
+            else:
+                if not result.unresolved:
+                    stream_resolver.invalidate(result.group_id)
+                logger.error(f"{self.log_prefix} {action}重试失败: {result.group_id} - {result.error}")
+                self._schedule_retry(result.group_id, entry.enable, result.error, config)
+
+    def _desired_state(self, group_id: str, config: Mapping[str, Any], now_ts: float) -> bool:
+        """某个群此刻应处的宵禁状态，宵禁功能没开时总是解禁"""
+        task = type(self)._curfew_task
+        if task is None or task.done():
+            return False
+        schedule = build_group_schedules(config, [group_id])[group_id]
+        return schedule.is_active(now_ts, group_offset(group_id, config["curfew"]["spread_seconds"]))
+
+    @classmethod
+    def _ensure_retry_worker(cls):
+        """重试队列里有东西时确保后台重试任务在运行"""
+        if len(retry_queue) and not cls._draining and (cls._retry_task is None or cls._retry_task.done()):
+            cls._retry_task = asyncio.create_task(cls._new_task_instance()._retry_worker_task())
+
+    @classmethod
+    def _new_task_instance(cls) -> "CurfewCommand":
+        """创建后台任务用的实例（这个实例会持续存在直到任务结束）"""
+        task_instance = cls.__new__(cls)
+        task_instance.message = None
+        task_instance._services = {}
+        task_instance.log_prefix = f"[Command:curfew]"
+        return task_instance
+
+    @classmethod
+    def _get_rate_limiter(cls, dispatch_config: Mapping[str, Any]) -> TokenBucket:
+        """获取所有分发共用的令牌桶，限速配置变化时重新创建"""
+        rate = dispatch_config["rate_per_second"]
+        burst = dispatch_config["burst"]
+        limiter = cls._rate_limiter
+        if limiter is None or limiter.rate != rate or limiter.capacity != max(1, burst):
+            limiter = cls._rate_limiter = TokenBucket(rate, burst)
+        return limiter
 
     async def _curfew_monitor_task(self, first_run:bool):
         """宵禁监控任务"""
         logger.info(f"{self.log_prefix} 监控任务启动")
-        last_state = None
+        scheduler = CurfewScheduler()
+        dispatch_config = self._load_config()["dispatch"]
+        stream_resolver.configure(dispatch_config["stream_cache_ttl"], dispatch_config["stream_negative_ttl"])
+        unresolved = stream_resolver.warm(self._permission_index().group_list)
+        if unresolved:
+            logger.warning(f"{self.log_prefix} 有{unresolved}个生效群聊找不到对应的聊天流")
+        owned: set = set()
+        # 上次关闭时没做完的群，状态不确定，第一次全量对账时不管记录如何都重新下发一次
+        interrupted = applied_states.load_interrupted()
+        if interrupted:
+            logger.info(f"{self.log_prefix} 上次关闭时有{len(interrupted)}个群没有完成切换，将重新对账")
         
+        heartbeat_task: Optional[asyncio.Task] = None
         try:
-            while True:
+            cluster.configure(self._load_config()["cluster"])
+            cluster.heartbeat(clock.time())
+            # 续租放在单独的任务里，分发一大批群的时候租约也不会过期
+            heartbeat_task = asyncio.create_task(self._cluster_heartbeat_task())
+            if cluster.enabled:
+                # 刚加入时先等一个心跳周期，让同时启动的实例互相看见，免得所有群先落到第一个启动的实例头上
+                await asyncio.sleep(cluster.heartbeat_interval)
+            wall_mark, mono_mark = clock.time(), clock.monotonic()
+            next_full_check = 0.0
+            while not type(self)._draining:
                 config = self._load_config()
-                current_state = self._is_in_curfew_time(config)
-                
-                if current_state != last_state:
-                    await self._apply_curfew_state(current_state, config, first=first_run)
-                    last_state = current_state
-                    first_run = True
-                    logger.info(f"{self.log_prefix} 宵禁功能状态变更: {'启用' if current_state else '禁用'}")
+                now_ts = clock.time()
+                now_mono = clock.monotonic()
+                # 墙上时间和单调时间走得不一样，说明系统时间被调过，堆里按旧时间算的切换时刻都作废
+                drift = (now_ts - wall_mark) - (now_mono - mono_mark)
+                wall_mark, mono_mark = now_ts, now_mono
+                if abs(drift) > 1:
+                    logger.warning(f"{self.log_prefix} 检测到系统时间跳变{drift:+.0f}秒，重新计算宵禁时刻")
+                    scheduler.config_version = None
+                cluster.configure(config["cluster"])
+                version = (config_store.version, night_overrides.version, cluster.version, cluster.alive())
+                check_interval = config["curfew"]["check_interval"]
+                if scheduler.config_version != version or config["curfew"]["scheduler_mode"] == "interval":
+                    # 配置、临时调整或者分片变了（或者是轮询模式）就重建调度堆并对本实例负责的群做一次对账
+                    permission_index = self._permission_index()
+                    shard = cluster.shard(permission_index.group_list)
+                    if cluster.enabled:
+                        self._adopt_groups([group_id for group_id in shard if group_id not in owned])
+                    owned = set(shard)
+                    group_schedules = build_group_schedules(config, shard)
+                    scheduler.rebuild(group_schedules, now_ts, version, config["curfew"]["spread_seconds"])
+                    await self._reconcile(scheduler.desired_states(now_ts), config, first_run, permission_index, interrupted)
+                    if interrupted:
+                        interrupted = {}
+                        applied_states.clear_interrupted()
+                    next_full_check = now_mono + (check_interval or 0)
+                elif check_interval and check_interval > 0 and now_mono >= next_full_check - 0.5:  # 定时器可能提前一点点触发
+                    # 兜底复查：不只看堆里到期的时段，按此刻的时间把本实例所有群的目标状态重新对一遍
+                    scheduler.pop_due(now_ts)
+                    await self._reconcile(scheduler.desired_states(now_ts), config, first_run, self._permission_index())
+                    next_full_check = now_mono + check_interval
+                else:
+                    await self._reconcile(scheduler.pop_due(now_ts), config, first_run)
                 
-                await asyncio.sleep(config["curfew"]["check_interval"])
+                await self._wait_for_wakeup(self._next_wakeup_delay(config, scheduler))
+            logger.info(f"{self.log_prefix} 插件正在关闭，监控任务停止调度")
         
         except asyncio.CancelledError:
             logger.info(f"{self.log_prefix} 监控任务已取消")
             raise
+        finally:
+            if heartbeat_task is not None:
+                heartbeat_task.cancel()
+            cluster.leave()
+
+    async def _cluster_heartbeat_task(self):
+        """定期续租，存活实例变化时叫醒监控任务重新分片"""
+        while True:
+            await asyncio.sleep(cluster.heartbeat_interval)
+            try:
+                cluster.configure(self._load_config()["cluster"])
+            except Exception:
+                pass  # 配置读不出来时沿用上一次的设置继续续租
+            if cluster.heartbeat(clock.time()):
+                type(self)._notify_config_changed()
+
+    def _adopt_groups(self, group_ids: List[str]):
+        """新分到本实例的群以共享库里的状态为准，别的实例已经处理过的群不会再发一遍指令"""
+        now = clock.time()
+        for group_id, (muted, since) in cluster.load_states(group_ids).items():
+            if applied_states.get(group_id) != muted or applied_states.since(group_id) != since:
+                applied_states.adopt(group_id, muted, since, now)
+
+    async def _reconcile(self, desired: Dict[str, bool], config: Mapping[str, Any], first_run: bool, permission_index: Optional[PermissionIndex] = None, interrupted: Optional[Mapping[str, bool]] = None):
+        """对比目标状态和已下发状态，只给不一致的群发指令
+
+        传入permission_index表示这是一次全量对账，已经移出生效群聊但仍处于禁言状态的群会被解禁。
+        interrupted里是上次关闭时没有做完的群，记录和目标一致也会再补发一次禁言指令（不发消息）。
+        """
+        removed: List[str] = []
+        if permission_index is not None:
+            removed = [
+                group_id for group_id in applied_states.muted_groups()
+                if not permission_index.has_group(group_id) and cluster.owns(group_id)
+            ]
+            for group_id in removed:
+                desired[group_id] = False
+
+        changes = applied_states.diff(desired)
+        resend = set()
+        for group_id in interrupted or ():
+            if group_id in desired and group_id not in changes:
+                changes[group_id] = desired[group_id]
+                resend.add(group_id)
+        if not changes:
+            return
+
+        # 按目标状态、是否要发提示消息分批
+        removed_set = set(removed)
+        batches: Dict[Tuple[bool, bool, bool], List[str]] = {}
+        for group_id, state in changes.items():
+            if group_id in removed_set or group_id in resend:
+                key = (state, False, False)  # 被移出的群只解禁、没做完的群只补发指令，都不发消息
+            else:
+                key = (state, first_run or applied_states.get(group_id) is not None, True)
+            batches.setdefault(key, []).append(group_id)
+        for (state, first, send_message), group_ids in batches.items():
+            audit_log.record("transition", "scheduler", muted=state, groups=len(group_ids))
+            await self._apply_curfew_state(state, config, send_message=send_message, first=first, groups=group_ids, sharded=True)
+            logger.info(f"{self.log_prefix} 宵禁功能状态变更: {'启用' if state else '禁用'}（{len(group_ids)}个群）")
+        for group_id in removed:
+            if applied_states.get(group_id) is False:
+                applied_states.forget(group_id)
+
+    def _next_wakeup_delay(self, config: Dict[str, Any], scheduler: CurfewScheduler) -> float:
+        """计算监控任务下一次醒来前需要休眠的秒数"""
+        curfew_config = config["curfew"]
+        check_interval = curfew_config["check_interval"]
+        if curfew_config["scheduler_mode"] == "interval":
+            return check_interval
+
+        # deadline模式：直接睡到最近一个群的开始/结束时刻，check_interval只是兜底的复查间隔
+        delay = MAX_SCHEDULER_SLEEP
+        if check_interval and check_interval > 0:
+            delay = min(delay, check_interval)
+        if cluster.enabled:
+            delay = min(delay, cluster.heartbeat_interval)  # 及时发现分片变化和租约过期
+        deadline = scheduler.next_deadline()
+        if deadline is not None:
+            delay = min(delay, deadline - clock.time())
+        return max(delay, 0.0)
+
+    async def _wait_for_wakeup(self, delay: float):
+        """休眠到指定时间，配置发生变化时提前醒来"""
+        event = type(self)._get_wakeup_event()
+        mono_before = clock.monotonic()
+        try:
+            await asyncio.wait_for(event.wait(), timeout=delay)
+            metrics.inc("curfew_monitor_wakeups_total", reason="config")
+            logger.debug(f"{self.log_prefix} 配置发生变化，提前唤醒监控任务")
+        except asyncio.TimeoutError:
+            # 实际醒来的时间比计划晚了多少
+            metrics.inc("curfew_monitor_wakeups_total", reason="timer")
+            metrics.observe("curfew_monitor_tick_lag_seconds", max(clock.monotonic() - mono_before - delay, 0.0))
+        event.clear()
+        metrics.maybe_export()
+
+    @classmethod
+    def _get_wakeup_event(cls) -> asyncio.Event:
+        """获取用于提前唤醒监控任务的事件"""
+        if cls._wakeup_event is None:
+            cls._wakeup_event = asyncio.Event()
+        return cls._wakeup_event
+
+    @classmethod
+    def _notify_config_changed(cls):
+        """配置被修改后唤醒监控任务重新计算"""
+        cls._get_wakeup_event().set()
 
     @classmethod
     async def _send_notification(cls, message: str, target_stream: str):
@@ -356,14 +2643,13 @@ class CurfewCommand(BaseCommand):
             await cls._send_notification("宵禁功能启用成功", target_stream)
             
             # 创建监控任务实例（这个实例会持续存在直到任务结束）
-            task_instance = cls.__new__(cls)
-            task_instance.message = None
-            task_instance._services = {}
-            task_instance.log_prefix = f"[Command:curfew]"
+            task_instance = cls._new_task_instance()
             first_run=False
             
             cls._curfew_task = asyncio.create_task(task_instance._curfew_monitor_task(first_run))
             cls._is_curfew_active = True
+            cls._set_enabled(True)
+            cls._ensure_retry_worker()  # 上次没重试完的操作接着重试
             logger.info(f"[Command:curfew] 定时任务已启动")
         else:
             await cls._send_notification("宵禁功能已经启用啦", target_stream)
@@ -382,24 +2668,134 @@ class CurfewCommand(BaseCommand):
                 pass
             cls._curfew_task = None
             cls._is_curfew_active = False
+            cls._set_enabled(False)
             logger.info(f"[Command:curfew] 定时任务已停止")
         else:
             await cls._send_notification("宵禁功能已经关啦", target_stream)
             logger.info(f"[Command:curfew] 没有运行中的任务")
 
+    @classmethod
+    def _set_enabled(cls, enabled: bool):
+        """记录宵禁是否开启，重启后据此自动恢复"""
+        try:
+            state_store.set_runtime("enabled", "1" if enabled else "0")
+        except Exception as e:
+            logger.error(f"[Command:curfew] 保存宵禁开关状态失败: {e}")
+
+    @classmethod
+    def schedule_resume(cls):
+        """插件加载时和麦麦启动完成时各调用一次：如果上次关闭前宵禁是开着的，就自动恢复
+
+        加载插件时事件循环可能还没跑起来，这时什么也不做，等CurfewStartupHandler收到启动事件再恢复。
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if cls._resume_task is None or cls._resume_task.done():
+            cls._resume_task = loop.create_task(cls._resume_from_state())
+
+    @classmethod
+    async def _resume_from_state(cls):
+        """按持久化的状态恢复监控任务，首轮对账只会给状态不一致的群发指令"""
+        if cls._draining:
+            return  # 启动事件来得太晚，插件已经在关闭了
+        try:
+            enabled = state_store.get_runtime("enabled") == "1"
+        except Exception as e:
+            logger.error(f"[Command:curfew] 读取宵禁开关状态失败: {e}")
+            return
+        if enabled and (cls._curfew_task is None or cls._curfew_task.done()):
+            cls._curfew_task = asyncio.create_task(cls._new_task_instance()._curfew_monitor_task(False))
+            cls._is_curfew_active = True
+            logger.info(f"[Command:curfew] 已按上次的状态自动恢复宵禁（{len(applied_states.states)}个群有记录）")
+        cls._ensure_retry_worker()
+
+    @classmethod
+    def _is_draining(cls) -> bool:
+        return cls._draining
+
     @classmethod
     async def cleanup_on_shutdown(cls):
-        """关闭时清理任务"""
+        """关闭时清理任务
+
+        先停止调度新的群操作，在drain_timeout内等进行中的群做完，超时就直接取消；
+        没做完的群会记进curfew_state.db，下次启动时只需要补这些群。
+        开启了unmute_on_shutdown时，还会在剩下的时间里并发解除所有已禁言群的禁言。
+        """
         logger.info(f"[Command:curfew] 正在清理...")
-        if cls._curfew_task and not cls._curfew_task.done():
-            cls._curfew_task.cancel()
+        try:
+            config = config_store.get()
+        except Exception as e:
+            logger.error(f"[Command:curfew] 加载配置失败，使用默认的关闭设置: {e}")
+            config = _freeze(_build_config({}))
+        shutdown_config = config["shutdown"]
+        deadline = clock.monotonic() + max(float(shutdown_config["drain_timeout"]), 0.0)
+        # 多实例时只有最后一个实例负责解禁，其他实例的群会被接手
+        unmute = shutdown_config["unmute_on_shutdown"] and cluster.is_last_member()
+
+        cls._draining = True
+        cls._notify_config_changed()  # 叫醒正在休眠的监控任务让它退出
+        retry_queue.changed_event().set()
+        monitor_finished = await cls._drain_task(cls._curfew_task, deadline)
+        await cls._drain_task(cls._retry_task, deadline)
+        cls._curfew_task = None
+        cls._retry_task = None
+        cls._resume_task = None
+        cls._is_curfew_active = False
+        cls._draining = False
+
+        # 没做完的禁言也可能已经生效了，一并解除
+        unmute_groups = set(applied_states.muted_groups()) | {group_id for group_id, state in applied_states.pending.items() if state}
+        if unmute and unmute_groups:
+            logger.info(f"[Command:curfew] 关闭前解除{len(unmute_groups)}个群的禁言")
+            task = asyncio.create_task(cls._new_task_instance()._apply_curfew_state(False, config, send_message=False, groups=sorted(unmute_groups), actor="shutdown"))
+            await cls._drain_task(task, deadline)
+
+        unfinished = applied_states.save_interrupted(clock.time())
+        audit_log.record("shutdown", "shutdown", unfinished=unfinished)
+        if unfinished:
+            logger.warning(f"[Command:curfew] 有{unfinished}个群在期限内没有完成切换，已记录，下次启动时会重新对账")
+        elif not monitor_finished:
+            logger.warning(f"[Command:curfew] 监控任务没能在期限内停止，已强制取消")
+        await config_writer.flush()
+        state_store.close()
+        cluster.close()
+        audit_log.close()
+        logger.info(f"[Command:curfew] 清理完成")
+
+    @staticmethod
+    async def _drain_task(task: Optional[asyncio.Task], deadline: float) -> bool:
+        """等任务自己结束，超过期限就取消，返回是不是在期限内正常结束的"""
+        if task is None or task.done():
+            return True
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout=max(deadline - clock.monotonic(), 0.0))
+            return True
+        except asyncio.TimeoutError:
+            task.cancel()
             try:
-                await cls._curfew_task
+                await task
             except asyncio.CancelledError:
                 pass
-            cls._curfew_task = None
-            cls._is_curfew_active = False
-            logger.info(f"[Command:curfew] 清理完成")
+            return False
+        except Exception as e:
+            logger.error(f"[Command:curfew] 后台任务异常结束: {e}")
+            return True
+
+class CurfewStartupHandler(BaseEventHandler):
+    """麦麦启动完成后恢复上次开着的宵禁，不用等到有人发/curfew指令"""
+
+    event_type = EventType.ON_START
+    handler_name = "curfew_startup_handler"
+    handler_description = "启动时按上次的状态自动恢复宵禁"
+    weight = 0
+    intercept_message = False
+
+    async def execute(self, message):
+        CurfewCommand.schedule_resume()
+        return True, True, None, None, None
+
 
 @register_plugin
 class CurfewPlugin(BasePlugin):
@@ -425,6 +2821,12 @@ class CurfewPlugin(BasePlugin):
         "curfew":"宵禁时间配置（支持热重载）",
         "messages":"宵禁前后的消息内容（支持热重载）",
         "permissions": "管理者用户配置（支持热重载）",
+        "dispatch": "批量禁言/解禁时的并发与限速配置（支持热重载）",
+        "cluster": "多个麦麦实例共同管理同一批群时的分片协调配置",
+        "audit": "操作记录配置（支持热重载）",
+        "shutdown": "插件关闭时的收尾配置",
+        "retry": "禁言/解禁失败后的重试配置（支持热重载）",
+        "metrics": "运行统计配置（支持热重载）",
         "logging": "日志记录配置",
     }
 
@@ -440,7 +2842,15 @@ class CurfewPlugin(BasePlugin):
         "curfew": {
             "start_time": ConfigField(type=str, default="23:00", description="宵禁开始时间（注意，不存在24:00，请使用0:00）"),
             "end_time": ConfigField(type=str, default="6:00", description="宵禁结束时间（同上，请注意不存在24:00）"),
-            "check_interval": ConfigField(type=int, default=60, description="每隔多长时间检查一次当前时间，如果不懂的话不要乱动这个数值"),
+            "check_interval": ConfigField(type=int, default=60, description="每隔多长时间检查一次当前时间。deadline模式下只是兜底复查的间隔，填0表示不额外复查，如果不懂的话不要乱动这个数值"),
+            "scheduler_mode": ConfigField(
+                type=str, default="deadline", description="调度方式：deadline会直接休眠到下一次宵禁开始/结束，interval则按check_interval定时轮询", choices=["deadline", "interval"]
+            ),
+            "timezone": ConfigField(type=str, default="", description="宵禁时间所用的时区，例如Asia/Shanghai，留空表示使用系统时区"),
+            "spread_seconds": ConfigField(type=int, default=0, description="错峰窗口（秒）：每个群会按群号分到一个固定的偏移，在这个窗口内陆续禁言/解禁，避免所有群同时操作。填0表示不错峰"),
+            "weekend_start_time": ConfigField(type=str, default="", description="周末的宵禁开始时间，留空表示和平日一样"),
+            "weekend_end_time": ConfigField(type=str, default="", description="周末的宵禁结束时间，留空表示和平日一样"),
+            "weekend_days": ConfigField(type=List, default=[4, 5], description="哪几天晚上算周末，按宵禁开始那天算，0是周一，6是周日，默认是周五和周六晚上"),
         },
         "messages": {
             "mute_message": ConfigField(type=str, default="宵禁时间到咯", description="宵禁开始时麦麦会说的话"),
@@ -449,6 +2859,41 @@ class CurfewPlugin(BasePlugin):
         "permissions": {
             "groups": ConfigField(type=List, default=["123456789"], description="宵禁插件将会生效的群聊，记得用英文单引号包裹并使用逗号分隔"),
             "admin_users": ConfigField(type=List, default=["123456789"], description="请写入被许可用户的QQ号，记得用英文单引号包裹并使用逗号分隔。这个配置会决定谁被允许使用宵禁状态调整指令"),
+            "denial_reply_cooldown": ConfigField(type=int, default=60, description="同一个人在同一个群里反复使用指令时，多少秒内只回复一次“权限不足”，填0表示每次都回复"),
+        },
+        "dispatch": {
+            "max_concurrency": ConfigField(type=int, default=8, description="同时处理多少个群的禁言/解禁"),
+            "rate_per_second": ConfigField(type=float, default=5.0, description="每秒最多调用多少次发消息/禁言接口，填0表示不限速"),
+            "burst": ConfigField(type=int, default=5, description="限速允许的瞬时突发调用次数"),
+            "stream_cache_ttl": ConfigField(type=int, default=604800, description="群号对应的聊天流缓存多少秒（发送失败或者增删群时会提前失效）"),
+            "stream_negative_ttl": ConfigField(type=int, default=60, description="找不到聊天流的群隔多少秒再重新查询"),
+        },
+        "audit": {
+            "enabled": ConfigField(type=bool, default=True, description="是否把每次切换、每个群的操作结果和配置修改写进操作记录文件"),
+            "path": ConfigField(type=str, default="", description="操作记录文件路径，留空表示插件目录下的curfew_audit.jsonl"),
+            "max_size_mb": ConfigField(type=int, default=5, description="单个记录文件最大多少MB，超过后轮转"),
+            "backups": ConfigField(type=int, default=3, description="轮转后最多保留几个旧文件"),
+        },
+        "shutdown": {
+            "drain_timeout": ConfigField(type=int, default=10, description="关闭时最多等多少秒让进行中的禁言/解禁做完，超时的群会记下来，下次启动时补上"),
+            "unmute_on_shutdown": ConfigField(type=bool, default=False, description="关闭时是否解除所有已禁言群的禁言（下次启动、宵禁仍开启时会按时段重新禁言）"),
+        },
+        "cluster": {
+            "enabled": ConfigField(type=bool, default=False, description="是否开启多实例协调。开启后所有实例按租约把群分片，每个群只由一个实例操作"),
+            "db_path": ConfigField(type=str, default="", description="各实例共用的sqlite文件路径（必须在同一台机器上），留空表示插件目录下的curfew_cluster.db"),
+            "instance_id": ConfigField(type=str, default="", description="本实例的名字，各实例不能重复，留空表示主机名加进程号"),
+            "lease_ttl": ConfigField(type=int, default=30, description="租约有效期（秒），实例超过这么久没有续租就视为下线，它的群会交给其他实例"),
+            "heartbeat_interval": ConfigField(type=int, default=10, description="多久续租一次（秒），要明显小于lease_ttl"),
+        },
+        "retry": {
+            "base_delay": ConfigField(type=int, default=5, description="第一次重试前等待的秒数，之后每次翻倍"),
+            "max_delay": ConfigField(type=int, default=600, description="两次重试之间最长等待的秒数"),
+            "max_attempts": ConfigField(type=int, default=0, description="同一个操作最多重试多少次，填0表示一直重试直到成功或者目标状态改变"),
+        },
+        "metrics": {
+            "enabled": ConfigField(type=bool, default=False, description="是否记录运行统计，开启后可以用/curfew stats查看"),
+            "export_path": ConfigField(type=str, default="", description="定期把统计数据以Prometheus文本格式写到这个文件，留空表示不导出"),
+            "export_interval": ConfigField(type=int, default=60, description="导出统计数据的最短间隔（秒）"),
         },
         "logging": {
             "level": ConfigField(
@@ -466,5 +2911,7 @@ class CurfewPlugin(BasePlugin):
 
         if self.get_config("components.enable_curfew", True):
             components.append((CurfewCommand.get_command_info(), CurfewCommand))
+            components.append((CurfewStartupHandler.get_handler_info(), CurfewStartupHandler))
+            CurfewCommand.schedule_resume()
 
         return components
@@ -0,0 +1,671 @@
+"""宵禁插件的离线模拟与基准测试工具
+
+不需要MaiBot本体：脚本会用本地替身顶替src.plugin_system里的send_api、chat_api和logger，
+再用虚拟时钟驱动插件自己的监控任务，普通的Linux机器上几秒钟就能跑完模拟的好几天。
+
+    python tools/curfew_harness.py simulate --groups 5000 --days 3
+    python tools/curfew_harness.py simulate --groups 50 --days 2 --outage 23:00-06:00
+    python tools/curfew_harness.py bench --groups 2000 --iterations 2000
+    python tools/curfew_harness.py cluster --nodes 3 --groups 60
+    python tools/curfew_harness.py cluster --nodes 2 --groups 40 --rate 5 --burst 1 --lease-ttl 3 --heartbeat 1 \
+        --join-after 2.5 --kill -1 --end-after 30 --duration 45
+
+cluster会真的启动几个进程共用一个协调库，中途杀掉其中一个，检查它的群有没有被其他实例正确接手；
+加上--rate和--join-after可以让一个实例在别的实例限速分发到一半时才加入，检查分片变化时有没有重复禁言。
+所有子命令都可以加--json，把结果以JSON输出，方便和之前的结果比较。
+simulate和cluster发现状态不一致、重复或者漏掉的操作时以1退出；--outage模拟整晚禁言失败，
+检查故障结束后过时的重试会不会在白天把群禁言。
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import math
+import multiprocessing
+import random
+import selectors
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+PLUGIN_SOURCE = Path(__file__).resolve().parent.parent / "curfew_plugin" / "plugin.py"
+ADMIN_ID = "10001"
+
+
+class VirtualClock:
+    """虚拟时钟：monotonic从0开始，time()是起始时间戳加上monotonic"""
+
+    def __init__(self, start_epoch: float):
+        self._epoch = start_epoch
+        self._elapsed = 0.0
+
+    def time(self) -> float:
+        return self._epoch + self._elapsed
+
+    def monotonic(self) -> float:
+        return self._elapsed
+
+    def advance(self, seconds: float):
+        self._elapsed += seconds
+
+
+class ShiftedClock:
+    """真实时钟加上一个固定偏移，多个进程用同一个偏移就能看到同一个“现在”"""
+
+    def __init__(self, offset: float):
+        self._offset = offset
+
+    def time(self) -> float:
+        return time.time() + self._offset
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    """没有就绪的IO时不真的等待，而是把虚拟时钟直接拨到下一个定时器"""
+
+    def __init__(self, clock: VirtualClock):
+        super().__init__()
+        self._clock = clock
+
+    def select(self, timeout: Optional[float] = None):
+        if timeout is None:
+            # 没有定时器，只可能在等线程池之类的真实事件
+            return super().select(None)
+        events = super().select(0)
+        if not events and timeout > 0:
+            self._clock.advance(timeout)
+        return events
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """使用虚拟时钟的事件循环，asyncio.sleep/wait_for都会瞬间完成"""
+
+    def __init__(self, clock: VirtualClock):
+        super().__init__(_VirtualSelector(clock))
+        self._virtual_clock = clock
+
+    def time(self) -> float:
+        return self._virtual_clock.monotonic()
+
+
+class FakeAdapter:
+    """send_api/chat_api的替身，记录所有调用，可以模拟延迟、失败和找不到聊天流的群"""
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, unresolved: Optional[set] = None, seed: int = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.unresolved = unresolved or set()
+        self.random = random.Random(seed)
+        self.messages = 0
+        self.commands = 0
+        self.failures = 0
+        self.lookups = 0
+        self.ban_state: Dict[str, bool] = {}
+        self.on_command: Optional[Callable[[str, bool], None]] = None
+        self.on_message: Optional[Callable[[str, str], None]] = None
+        self.outage: Optional[Callable[[], bool]] = None  # 返回True时所有禁言/解禁指令都失败
+
+    async def text_to_stream(self, content: str, stream_id: str, *args, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.messages += 1
+        if self.on_message is not None:
+            self.on_message(stream_id, content)
+        return True
+
+    async def command_to_stream(self, command: Dict[str, Any], stream_id: str, *args, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.failures += 1
+            raise RuntimeError("模拟的适配器错误")
+        if self.outage is not None and self.outage():
+            self.failures += 1
+            raise RuntimeError("模拟的适配器故障")
+        self.commands += 1
+        if command.get("name") == "GROUP_WHOLE_BAN":
+            self.ban_state[stream_id] = bool(command["args"]["enable"])
+            if self.on_command is not None:
+                self.on_command(stream_id, bool(command["args"]["enable"]))
+        return True
+
+    def get_stream_by_group_id(self, group_id: str):
+        self.lookups += 1
+        if group_id in self.unresolved:
+            return None
+        return types.SimpleNamespace(stream_id=f"stream-{group_id}")
+
+    def counters(self) -> Dict[str, int]:
+        return {"messages": self.messages, "commands": self.commands, "failures": self.failures, "lookups": self.lookups}
+
+
+def install_stubs(adapter: FakeAdapter, verbose: bool = False):
+    """在sys.modules里放入插件依赖的src.*模块替身"""
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    def get_logger(name: str) -> logging.Logger:
+        log = logging.getLogger(name)
+        log.setLevel(logging.INFO if verbose else logging.CRITICAL)
+        return log
+
+    class ConfigField:
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    class BasePlugin:
+        def __init__(self, *args, **kwargs):
+            pass
+
+    class BaseCommand:
+        def __init__(self, message, plugin_config: dict = None):
+            self.message = message
+            self.plugin_config = plugin_config or {}
+            self.matched_groups: Dict[str, Optional[str]] = {}
+
+        @classmethod
+        def get_command_info(cls):
+            return None
+
+    class BaseEventHandler:
+        @classmethod
+        def get_handler_info(cls):
+            return None
+
+    modules = {
+        "src": {},
+        "src.common": {},
+        "src.common.logger": {"get_logger": get_logger},
+        "src.plugin_system": {},
+        "src.plugin_system.base": {},
+        "src.plugin_system.base.config_types": {"ConfigField": ConfigField},
+        "src.plugin_system.base.base_plugin": {"BasePlugin": BasePlugin},
+        "src.plugin_system.base.base_command": {"BaseCommand": BaseCommand},
+        "src.plugin_system.base.base_events_handler": {"BaseEventHandler": BaseEventHandler},
+        "src.plugin_system.base.component_types": {"ComponentInfo": object, "EventType": types.SimpleNamespace(ON_START="on_start")},
+        "src.plugin_system.apis": {"send_api": adapter, "chat_api": adapter},
+        "src.plugin_system.apis.plugin_register_api": {"register_plugin": lambda cls: cls},
+    }
+    for name, attrs in modules.items():
+        module = types.ModuleType(name)
+        module.__path__ = []
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+
+
+def _prepare(workdir: Path) -> Path:
+    plugin_dir = workdir / "curfew_plugin"
+    plugin_dir.mkdir(parents=True, exist_ok=True)
+    return plugin_dir
+
+
+def write_config(path: Path, groups: List[str], start_time: str, end_time: str, spread_seconds: int,
+                 rate_per_second: float, variants: int, timezone: str, burst: int = 32):
+    """生成模拟用的config.toml，variants>1时把一部分群分到不同的时段上"""
+    group_list = ", ".join(f'"{group_id}"' for group_id in groups)
+    lines = [
+        "[curfew]",
+        f'start_time = "{start_time}"',
+        f'end_time = "{end_time}"',
+        "check_interval = 0",
+        f'timezone = "{timezone}"',
+        f"spread_seconds = {spread_seconds}",
+        "",
+        "[messages]",
+        'mute_message = "宵禁时间到咯"',
+        'unmute_message = "宵禁时间结束咯"',
+        "",
+        "[permissions]",
+        f"groups = [{group_list}]",
+        f'admin_users = ["{ADMIN_ID}"]',
+        "",
+        "[dispatch]",
+        "max_concurrency = 32",
+        f"rate_per_second = {rate_per_second}",
+        f"burst = {burst}",
+        "",
+        "[retry]",
+        "base_delay = 5",
+        "max_delay = 600",
+        "max_attempts = 0",
+        "",
+        "[metrics]",
+        "enabled = true",
+        "",
+    ]
+    for index, group_id in enumerate(groups[:variants - 1] if variants > 1 else []):
+        lines += [f'[schedules."{group_id}"]', f'start_time = "{22 - index % 3}:{(index * 7) % 60:02d}"', ""]
+    path.write_text("\n".join(lines), encoding="utf-8")
+
+
+def load_plugin(workdir: Path):
+    """把plugin.py复制到临时目录里再导入，配置和状态库都落在那个目录"""
+    plugin_dir = _prepare(workdir)
+    shutil.copy(PLUGIN_SOURCE, plugin_dir / "plugin.py")
+    spec = importlib.util.spec_from_file_location("curfew_plugin_harness", plugin_dir / "plugin.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_command(plugin, text: str, user_id: str, group_id: Optional[str]):
+    """构造一个带假消息的CurfewCommand实例"""
+    group_info = types.SimpleNamespace(group_id=group_id) if group_id is not None else None
+    message = types.SimpleNamespace(
+        message_info=types.SimpleNamespace(user_info=types.SimpleNamespace(user_id=user_id), group_info=group_info),
+        chat_stream=types.SimpleNamespace(stream_id=f"stream-{group_id or user_id}"),
+    )
+    command = plugin.CurfewCommand(message, {})
+    match = plugin.re.match(plugin.CurfewCommand.command_pattern, text)
+    command.matched_groups = match.groupdict() if match else {}
+    return command
+
+
+def _histogram(plugin, name: str) -> Dict[str, float]:
+    merged = plugin.Histogram()
+    for (metric, _), histogram in plugin.metrics.histograms.items():
+        if metric == name:
+            for index, count in enumerate(histogram.counts):
+                merged.counts[index] += count
+            merged.count += histogram.count
+            merged.total += histogram.total
+            merged.max = max(merged.max, histogram.max)
+    return {"count": merged.count, "max": merged.max, "p95": merged.quantile(0.95)}
+
+
+def _parse_outage(text: str) -> Callable[[datetime], bool]:
+    """把"23:00-06:00"解析成判断某个本地时刻是否在故障时段内的函数，可以跨过零点"""
+    start, end = (datetime.strptime(part.strip(), "%H:%M").time() for part in text.split("-"))
+    if start <= end:
+        return lambda moment: start <= moment.time() < end
+    return lambda moment: moment.time() >= start or moment.time() < end
+
+
+def simulate(args) -> Dict[str, Any]:
+    """用虚拟时钟让监控任务连续跑args.days天，统计指令数量并核对每个群最终的禁言状态
+
+    每条禁言/解禁指令发出时都会和插件自己算出的目标状态比对，和目标相反的指令记为wrong_commands，
+    例如故障时段里没发出去的禁言，在时段结束以后又被过时的重试补发了出来。
+    """
+    adapter = FakeAdapter(latency=args.latency, failure_rate=args.failure_rate, seed=args.seed)
+    install_stubs(adapter, args.verbose)
+    workdir = Path(tempfile.mkdtemp(prefix="curfew-sim-"))
+    groups = [str(100000 + index) for index in range(args.groups)]
+    write_config(_prepare(workdir) / "config.toml", groups, args.start_time, args.end_time, args.spread, args.rate, args.variants, args.timezone)
+    plugin = load_plugin(workdir)
+
+    start_epoch = datetime.strptime(args.start, "%Y-%m-%d %H:%M").timestamp()
+    clock = VirtualClock(start_epoch)
+    plugin.clock = clock
+    loop = VirtualTimeLoop(clock)
+    asyncio.set_event_loop(loop)
+
+    if args.outage:
+        in_outage = _parse_outage(args.outage)
+        adapter.outage = lambda: in_outage(datetime.fromtimestamp(clock.time()))
+    wrong_commands: List[Dict[str, Any]] = []
+
+    def check_command(stream_id: str, enable: bool):
+        group_id = stream_id[len("stream-"):]
+        config = plugin.config_store.get()
+        schedule = plugin.build_group_schedules(config, [group_id])[group_id]
+        now = clock.time()
+        if enable != schedule.is_active(now, plugin.group_offset(group_id, config["curfew"]["spread_seconds"])):
+            wrong_commands.append({"group": group_id, "enable": enable, "at": datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S")})
+
+    adapter.on_command = check_command
+
+    per_day: List[Dict[str, int]] = []
+
+    async def run():
+        await plugin.CurfewCommand._start_curfew_task("stream-admin")
+        previous = adapter.counters()
+        for _ in range(args.days):
+            await asyncio.sleep(86400)
+            current = adapter.counters()
+            per_day.append({key: current[key] - previous[key] for key in current})
+            previous = current
+        await plugin.CurfewCommand.cleanup_on_shutdown()
+
+    wall_started = time.perf_counter()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+    wall_elapsed = time.perf_counter() - wall_started
+
+    # 用插件自己的时段计算核对最后时刻每个群应处的状态
+    config = plugin.config_store.get()
+    schedules = plugin.build_group_schedules(config, groups)
+    spread = config["curfew"]["spread_seconds"]
+    now = clock.time()
+    mismatched = [
+        group_id for group_id, schedule in schedules.items()
+        if adapter.ban_state.get(f"stream-{group_id}", False) != schedule.is_active(now, plugin.group_offset(group_id, spread))
+    ]
+    wakeups = sum(value for (name, _), value in plugin.metrics.counters.items() if name == "curfew_monitor_wakeups_total")
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "groups": args.groups,
+        "days": args.days,
+        "wall_seconds": round(wall_elapsed, 3),
+        "totals": adapter.counters(),
+        "per_day": per_day,
+        "monitor_wakeups": wakeups,
+        "tick_lag_seconds": _histogram(plugin, "curfew_monitor_tick_lag_seconds"),
+        "fanout_seconds": _histogram(plugin, "curfew_fanout_seconds"),
+        "mismatched_groups": len(mismatched),
+        "pending_retries": len(plugin.retry_queue),
+        "wrong_commands": len(wrong_commands),
+        "wrong_command_samples": wrong_commands[:5],
+    }
+
+
+BENCH_CASES = [
+    # （名称, 指令, 发送者, 所在群）；群号None表示私聊，指令是元组时按顺序轮流执行
+    ("true/false", ("/curfew true", "/curfew false"), ADMIN_ID, "100000"),
+    ("time list", "/curfew time list", ADMIN_ID, "100000"),
+    ("time list (private)", "/curfew time list", ADMIN_ID, None),
+    ("permission_group list", "/curfew permission_group list", ADMIN_ID, "100000"),
+    ("start_time set", "/curfew start_time set 23:00", ADMIN_ID, "100000"),
+    ("end_time set", "/curfew end_time set 6:00", ADMIN_ID, "100000"),
+    ("weekend_start_time set", "/curfew weekend_start_time set 0:30", ADMIN_ID, "100000"),
+    ("weekend_end_time set", "/curfew weekend_end_time set 9:00", ADMIN_ID, "100000"),
+    ("timezone set", "/curfew timezone set Asia/Shanghai", ADMIN_ID, "100000"),
+    ("tonight", "/curfew tonight", ADMIN_ID, "100000"),
+    ("tonight skip/clear", ("/curfew tonight skip", "/curfew tonight clear"), ADMIN_ID, "100000"),
+    ("permission_group add/remove", ("/curfew permission_group add 88888888", "/curfew permission_group remove 88888888"), ADMIN_ID, "100000"),
+    ("stats", "/curfew stats", ADMIN_ID, "100000"),
+    ("status", "/curfew status", ADMIN_ID, "100000"),
+    ("status (private)", "/curfew status", ADMIN_ID, None),
+    ("bad operation", "/curfew nonsense", ADMIN_ID, "100000"),
+    ("unauthorized user", "/curfew time list", "99999", "100000"),
+    ("unmanaged group", "/curfew time list", ADMIN_ID, "999999"),
+]
+# 每次都要给所有生效群聊下发指令的子命令，执行次数有上限，免得一次基准测试跑好几分钟
+BENCH_ITERATION_LIMITS = {"true/false": 100}
+
+
+def bench(args) -> Dict[str, Any]:
+    """逐个子命令测量execute的吞吐量和延迟，以及每次调用产生的出站消息数量"""
+    adapter = FakeAdapter(seed=args.seed)
+    install_stubs(adapter, args.verbose)
+    workdir = Path(tempfile.mkdtemp(prefix="curfew-bench-"))
+    groups = [str(100000 + index) for index in range(args.groups)]
+    write_config(_prepare(workdir) / "config.toml", groups, "23:00", "06:00", 0, 0, 1, "")
+    plugin = load_plugin(workdir)
+
+    async def run_case(name: str, text: Any, user_id: str, group_id: Optional[str]) -> Dict[str, Any]:
+        latencies: List[float] = []
+        before = adapter.counters()
+        for index in range(min(args.iterations, BENCH_ITERATION_LIMITS.get(name, args.iterations))):
+            command_text = text[index % len(text)] if isinstance(text, tuple) else text
+            command = make_command(plugin, command_text, user_id, group_id)
+            started = time.perf_counter()
+            await command.execute()
+            latencies.append(time.perf_counter() - started)
+        after = adapter.counters()
+        latencies.sort()
+        total = sum(latencies)
+        return {
+            "case": name,
+            "iterations": len(latencies),
+            "ops_per_second": round(len(latencies) / total, 1) if total else None,
+            "p50_ms": round(statistics.median(latencies) * 1000, 4),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 4),
+            "max_ms": round(latencies[-1] * 1000, 4),
+            "messages_per_op": round((after["messages"] - before["messages"]) / len(latencies), 3),
+        }
+
+    async def run() -> List[Dict[str, Any]]:
+        results = []
+        for case in BENCH_CASES:
+            results.append(await run_case(*case))
+        await plugin.CurfewCommand.cleanup_on_shutdown()
+        return results
+
+    results = asyncio.run(run())
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {"groups": args.groups, "iterations": args.iterations, "cases": results}
+
+
+def _cluster_node(instance_id: str, workdir: str, cluster_db: str, groups: List[str], start_time: str, end_time: str,
+                  clock_offset: float, duration: float, lease_ttl: float, heartbeat: float, events_path: str,
+                  rate: float = 0.0, burst: int = 32, start_delay: float = 0.0):
+    """cluster子命令里每个子进程跑的实例：开启宵禁，把每次禁言/解禁和提示消息追加写进events_path
+
+    start_delay大于0时这个实例晚一点才启动，用来模拟别的实例正在分发时有新实例加入。
+    """
+    time.sleep(start_delay)
+    adapter = FakeAdapter(latency=0.01)
+    install_stubs(adapter)
+    node_dir = Path(workdir) / instance_id
+    config_path = _prepare(node_dir) / "config.toml"
+    write_config(config_path, groups, start_time, end_time, 0, rate, 1, "", burst)
+    with open(config_path, "a", encoding="utf-8") as config_file:
+        config_file.write(
+            "\n[cluster]\nenabled = true\n"
+            f"db_path = {json.dumps(cluster_db)}\ninstance_id = \"{instance_id}\"\n"
+            f"lease_ttl = {lease_ttl}\nheartbeat_interval = {heartbeat}\n"
+        )
+    plugin = load_plugin(node_dir)
+    plugin.clock = ShiftedClock(clock_offset)
+    events = open(events_path, "a", encoding="utf-8")
+
+    def record(stream_id: str, enable: bool, kind: str = "command"):
+        events.write(json.dumps({
+            "node": instance_id, "group": stream_id[len("stream-"):], "kind": kind, "enable": enable, "at": plugin.clock.time(),
+        }) + "\n")
+        events.flush()
+
+    adapter.on_command = record
+    adapter.on_message = lambda stream_id, content: record(stream_id, content == "宵禁时间到咯", "message")
+
+    async def run():
+        await plugin.CurfewCommand._start_curfew_task("stream-admin")
+        await asyncio.sleep(duration)
+        await plugin.CurfewCommand.cleanup_on_shutdown()
+
+    asyncio.run(run())
+
+
+def cluster_demo(args) -> Dict[str, Any]:
+    """启动args.nodes个实例进程共同管理一批群，中途杀掉一个，核对每个群是否恰好被禁言、解禁各一次
+
+    join_after大于0时最后一个实例晚这么多秒才启动；配合限速，可以让它在其他实例还在分发禁言时加入。
+    """
+    workdir = Path(tempfile.mkdtemp(prefix="curfew-cluster-"))
+    cluster_db = str(workdir / "curfew_cluster.db")
+    events_path = str(workdir / "events.jsonl")
+    groups = [str(100000 + index) for index in range(args.groups)]
+    nodes = [f"node-{index}" for index in range(args.nodes)]
+    victim = nodes[args.kill] if 0 <= args.kill < len(nodes) else None
+
+    # 把所有进程的时钟拨到"离宵禁结束还有end_after秒"，这样不用真的等到晚上
+    now = time.time()
+    boundary = math.ceil((now + args.end_after) / 60) * 60 + 60
+    clock_offset = boundary - args.end_after - now
+    end_time = datetime.fromtimestamp(boundary).strftime("%H:%M")
+    start_time = datetime.fromtimestamp(boundary - 7200).strftime("%H:%M")
+
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    for index, instance_id in enumerate(nodes):
+        start_delay = args.join_after if args.join_after > 0 and index == len(nodes) - 1 else 0.0
+        process = context.Process(target=_cluster_node, args=(
+            instance_id, str(workdir), cluster_db, groups, start_time, end_time,
+            clock_offset, args.duration, args.lease_ttl, args.heartbeat, events_path,
+            args.rate, args.burst, start_delay,
+        ))
+        process.start()
+        processes[instance_id] = process
+    started = time.monotonic()
+    if victim is not None:
+        time.sleep(args.kill_after)
+        processes[victim].kill()
+    for process in processes.values():
+        process.join(args.duration + args.join_after + 30)
+    wall_elapsed = time.monotonic() - started
+
+    events = []
+    with open(events_path, encoding="utf-8") as events_file:
+        for line in events_file:
+            events.append(json.loads(line))
+    mutes: Dict[str, List[str]] = {group_id: [] for group_id in groups}
+    unmutes: Dict[str, List[str]] = {group_id: [] for group_id in groups}
+    mute_messages: Dict[str, int] = {group_id: 0 for group_id in groups}
+    for event in events:
+        if event.get("kind") == "message":
+            if event["enable"]:
+                mute_messages[event["group"]] += 1
+            continue
+        (mutes if event["enable"] else unmutes)[event["group"]].append(event["node"])
+
+    # 宵禁结束时存活的实例按同样的rendezvous哈希分片，解禁应该由各群的新主人发出
+    adapter = FakeAdapter()
+    install_stubs(adapter)
+    plugin = load_plugin(workdir / "verify")
+    survivors = [instance_id for instance_id in nodes if instance_id != victim]
+    wrong_owner = [
+        group_id for group_id in groups
+        if len(unmutes[group_id]) == 1 and unmutes[group_id][0] != plugin.rendezvous_owner(group_id, survivors)
+    ]
+    taken_over = [group_id for group_id in groups if mutes[group_id] == [victim] and unmutes[group_id] and unmutes[group_id][0] != victim]
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "nodes": nodes,
+        "killed": victim,
+        "groups": len(groups),
+        "wall_seconds": round(wall_elapsed, 1),
+        "mutes_by_node": {instance_id: sum(nodes_.count(instance_id) for nodes_ in mutes.values()) for instance_id in nodes},
+        "unmutes_by_node": {instance_id: sum(nodes_.count(instance_id) for nodes_ in unmutes.values()) for instance_id in nodes},
+        "groups_taken_over": len(taken_over),
+        "duplicate_mutes": sum(max(len(value) - 1, 0) for value in mutes.values()),
+        "duplicate_unmutes": sum(max(len(value) - 1, 0) for value in unmutes.values()),
+        "duplicate_mute_messages": sum(max(count - 1, 0) for count in mute_messages.values()),
+        "missed_mutes": sum(1 for value in mutes.values() if not value),
+        "missed_unmutes": sum(1 for value in unmutes.values() if not value),
+        "wrong_owner": len(wrong_owner),
+    }
+
+
+def _print_simulation(result: Dict[str, Any]):
+    print(f"模拟了{result['days']}天、{result['groups']}个群，实际耗时{result['wall_seconds']}秒")
+    totals = result["totals"]
+    print(f"指令{totals['commands']}次，消息{totals['messages']}条，失败{totals['failures']}次，查询聊天流{totals['lookups']}次")
+    for day, counters in enumerate(result["per_day"], 1):
+        print(f"  第{day}天: 指令{counters['commands']}次，消息{counters['messages']}条，失败{counters['failures']}次")
+    lag = result["tick_lag_seconds"]
+    print(f"监控任务醒来{result['monitor_wakeups']:g}次，延迟p95≈{lag['p95']:.3f}秒，最大{lag['max']:.3f}秒")
+    fanout = result["fanout_seconds"]
+    print(f"批量操作{fanout['count']}次，最慢{fanout['max']:.1f}秒（虚拟时间）")
+    print(f"状态不一致的群: {result['mismatched_groups']}，还在重试队列里的群: {result['pending_retries']}，和目标状态相反的指令: {result['wrong_commands']}")
+    for sample in result["wrong_command_samples"]:
+        print(f"  {sample['at']} 群{sample['group']}收到了{'禁言' if sample['enable'] else '解禁'}指令")
+
+
+def _print_bench(result: Dict[str, Any]):
+    print(f"{result['groups']}个生效群聊，每个子命令执行{result['iterations']}次")
+    print(f"{'子命令':<30}{'次数':>8}{'次/秒':>12}{'p50(ms)':>10}{'p95(ms)':>10}{'max(ms)':>10}{'消息/次':>9}")
+    for case in result["cases"]:
+        print(
+            f"{case['case']:<30}{case['iterations']:>8}{case['ops_per_second']:>12}{case['p50_ms']:>10.3f}"
+            f"{case['p95_ms']:>10.3f}{case['max_ms']:>10.3f}{case['messages_per_op']:>9}"
+        )
+
+
+def _print_cluster(result: Dict[str, Any]):
+    print(f"{len(result['nodes'])}个实例共同管理{result['groups']}个群，杀掉了{result['killed'] or '（无）'}，实际耗时{result['wall_seconds']}秒")
+    for instance_id in result["nodes"]:
+        print(f"  {instance_id}: 禁言{result['mutes_by_node'][instance_id]}次，解禁{result['unmutes_by_node'][instance_id]}次")
+    print(f"被接手的群: {result['groups_taken_over']}")
+    print(f"重复禁言: {result['duplicate_mutes']}，重复解禁: {result['duplicate_unmutes']}，重复的宵禁提示: {result['duplicate_mute_messages']}")
+    print(f"漏掉的禁言: {result['missed_mutes']}，漏掉的解禁: {result['missed_unmutes']}，解禁实例和分片不符: {result['wrong_owner']}")
+
+
+def violations(mode: str, result: Dict[str, Any]) -> List[str]:
+    """结果里违反不变量的项，非空时脚本以1退出，方便在CI里直接当检查用"""
+    if mode == "simulate":
+        keys = ["mismatched_groups", "pending_retries", "wrong_commands"]
+    elif mode == "cluster":
+        keys = ["duplicate_mutes", "duplicate_unmutes", "duplicate_mute_messages", "missed_mutes", "missed_unmutes", "wrong_owner"]
+    else:
+        return []
+    return [f"{key}={result[key]}" for key in keys if result[key]]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="宵禁插件离线模拟与基准测试")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    sim = subparsers.add_parser("simulate", help="用虚拟时钟快进监控任务")
+    sim.add_argument("--groups", type=int, default=1000)
+    sim.add_argument("--days", type=int, default=2)
+    sim.add_argument("--start", default="2026-01-01 12:00", help="模拟开始的本地时间")
+    sim.add_argument("--start-time", default="23:00")
+    sim.add_argument("--end-time", default="06:00")
+    sim.add_argument("--timezone", default="")
+    sim.add_argument("--spread", type=int, default=0, help="错峰窗口（秒）")
+    sim.add_argument("--variants", type=int, default=1, help="单独设置时段的群数量+1")
+    sim.add_argument("--rate", type=float, default=20.0, help="每秒最多调用多少次接口，0表示不限速")
+    sim.add_argument("--latency", type=float, default=0.05, help="每次接口调用的模拟耗时（秒）")
+    sim.add_argument("--failure-rate", type=float, default=0.0, help="禁言指令的模拟失败率")
+    sim.add_argument("--outage", default="", help="每天这段本地时间内所有禁言/解禁指令都失败，例如23:00-06:00")
+
+    bench_parser = subparsers.add_parser("bench", help="测量各个子命令execute的吞吐量")
+    bench_parser.add_argument("--groups", type=int, default=1000)
+    bench_parser.add_argument("--iterations", type=int, default=1000)
+
+    cluster_parser = subparsers.add_parser("cluster", help="多进程演示实例分片和故障接管")
+    cluster_parser.add_argument("--nodes", type=int, default=3)
+    cluster_parser.add_argument("--groups", type=int, default=60)
+    cluster_parser.add_argument("--kill", type=int, default=1, help="要杀掉的实例序号，-1表示不杀")
+    cluster_parser.add_argument("--kill-after", type=float, default=4.0, help="启动后多少秒杀掉实例")
+    cluster_parser.add_argument("--end-after", type=float, default=12.0, help="启动后多少秒宵禁结束")
+    cluster_parser.add_argument("--duration", type=float, default=16.0, help="每个实例运行多少秒")
+    cluster_parser.add_argument("--lease-ttl", type=float, default=2.0)
+    cluster_parser.add_argument("--heartbeat", type=float, default=0.5)
+    cluster_parser.add_argument("--rate", type=float, default=0.0, help="每个实例每秒最多调用多少次接口，0表示不限速")
+    cluster_parser.add_argument("--burst", type=int, default=32)
+    cluster_parser.add_argument("--join-after", type=float, default=0.0, help="最后一个实例晚多少秒启动，0表示同时启动")
+    cluster_parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+
+    for sub in (sim, bench_parser):
+        sub.add_argument("--seed", type=int, default=0)
+        sub.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+        sub.add_argument("--verbose", action="store_true", help="输出插件的INFO日志")
+
+    args = parser.parse_args(argv)
+    if args.mode == "simulate":
+        result = simulate(args)
+        printer = _print_simulation
+    elif args.mode == "cluster":
+        result = cluster_demo(args)
+        printer = _print_cluster
+    else:
+        result = bench(args)
+        printer = _print_bench
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        printer(result)
+    failed = violations(args.mode, result)
+    if failed:
+        print(f"不变量检查失败: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())